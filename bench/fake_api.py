@@ -0,0 +1,81 @@
+"""
+Local stand-in for the StackExchange API, serves synthetic questions with paging, gzip and quota fields.
+"""
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+QUOTA_MAX = 10000
+
+
+class FakeStackExchange:
+    def __init__(self, questions: Dict[str, List[Dict]], latency: float = 0.0):
+        """
+        questions maps api_site_parameter to items returned by questions/unanswered, latency is added
+        to every response.
+        """
+        self.questions = questions
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/2.3".format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-api", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, method: str, params: Dict[str, str]) -> Dict:
+        with self._lock:
+            self.requests += 1
+            remaining = QUOTA_MAX - self.requests
+        res = {"quota_max": QUOTA_MAX, "quota_remaining": remaining, "has_more": False, "items": []}
+        if method == "filters/create":
+            res["items"] = [{"filter": "bench"}]
+        elif method == "sites":
+            res["items"] = [{"api_site_parameter": site} for site in self.questions]
+        elif method == "questions/unanswered":
+            items = self.questions.get(params.get("site"), [])
+            page = int(params.get("page", 1))
+            page_size = int(params.get("pagesize", 30))
+            res["items"] = items[(page - 1) * page_size:page * page_size]
+            res["has_more"] = page * page_size < len(items)
+        return res
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                method = url.path[len("/2.3/"):]
+                if api.latency > 0:
+                    time.sleep(api.latency)
+                body = json.dumps(api.respond(method, params)).encode()
+                # the real API always compresses responses
+                body = gzip.compress(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,20 @@
+"""
+Stand-in for telegram.Bot, accepts messages after a fixed latency and counts them.
+"""
+import threading
+import time
+
+
+class FakeBot:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = 0
+        self.chars = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id: int, text: str):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent += 1
+            self.chars += len(text)
@@ -0,0 +1,85 @@
+"""
+Compare matching engines on synthetic subscriptions, run from the repository root:
+python3 -m bench.matcher --subs 1000 10000 100000
+"""
+import argparse
+import random
+import time
+
+from lib.matcher import TagMatcher, load_numpy
+from lib.question import Question
+
+from bench.synthetic import zipf_tags
+
+
+def build(subs: int, seed: int) -> TagMatcher:
+    rnd = random.Random(seed)
+    matcher = TagMatcher(1)
+    for i in range(subs):
+        matcher.add(i, rnd.randint(1, subs // 2 + 1), zipf_tags(rnd, rnd.randint(1, 3)),
+                    zipf_tags(rnd, rnd.randint(0, 1)), zipf_tags(rnd, rnd.randint(0, 1)))
+    return matcher
+
+
+def questions(cnt: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    return [Question("title", "link", i, 0, zipf_tags(rnd, rnd.randint(1, 5))) for i in range(cnt)]
+
+
+def check_edge_pages(matcher: TagMatcher):
+    """
+    Synthetic pages always have hits, so pages without candidates and with all candidates excluded are checked
+    apart.
+    """
+    no_hits = [Question("title", "link", 0, 0, ["no-such-tag"])]
+    assert matcher.match_all_vectorized(no_hits) == matcher.match_all(no_hits) == {}
+    small = TagMatcher(2)
+    small.add(1, 1, ["python"], [], ["django"])
+    small.add(2, 2, [], ["python", "flask"], ["django"])
+    small.add(3, 3, ["java"], [], [])
+    excluded = [Question("title", "link", 0, 0, ["python", "flask", "django"])]
+    assert small.match_all_vectorized(excluded) == small.match_all(excluded) == {}
+
+
+def measure(func, batch: list, repeat: int) -> float:
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(batch)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matching engines benchmark")
+    parser.add_argument("--subs", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--questions", type=int, default=100, help="questions per batch, 100 is one API page")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    has_numpy = load_numpy() is not None
+    if not has_numpy:
+        print("numpy isn't installed, only the python engine is measured")
+    batch = questions(args.questions, args.seed)
+    print("{:>8} {:>12} {:>12} {:>12} {:>10}".format("subs", "python ms", "numpy ms", "compile ms", "matches"))
+    for subs in args.subs:
+        matcher = build(subs, args.seed)
+        python_time = measure(matcher.match_all, batch, args.repeat)
+        matches = sum(len(i) for i in matcher.match_all(batch).values())
+        numpy_time = compile_time = None
+        if has_numpy:
+            started = time.perf_counter()
+            matcher.match_all_vectorized([])
+            compile_time = time.perf_counter() - started
+            numpy_time = measure(matcher.match_all_vectorized, batch, args.repeat)
+            assert matcher.match_all_vectorized(batch) == matcher.match_all(batch)
+            check_edge_pages(matcher)
+        print("{:>8} {:>12} {:>12} {:>12} {:>10}".format(
+            subs, round(python_time * 1000, 2), "-" if numpy_time is None else round(numpy_time * 1000, 2),
+            "-" if compile_time is None else round(compile_time * 1000, 1), matches))
+
+
+if __name__ == "__main__":
+    main()
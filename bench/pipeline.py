@@ -0,0 +1,232 @@
+"""
+Fetch, match and notify benchmark over synthetic data and fake backends, run from the repository root:
+python3 -m bench.pipeline --subs 1000 10000 100000
+
+Questions are served by a local fake StackExchange API and messages go to a fake bot, so only the bot's own
+code is measured. With --dsn the SQL engine and outbox writes are measured too, the database has to be
+a disposable one: stackexchange_db schema is created there and dropped afterwards.
+"""
+import argparse
+import logging
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from lib import log
+from lib.api import ApiClient
+from lib.matcher import MatcherRegistry, load_numpy, match_in_db, ENGINE_NUMPY, ENGINE_PYTHON, ENGINE_SQL
+from lib.notifier import Notifier
+from lib.outbox import format_question, save_matches
+
+from bench.fake_api import FakeStackExchange
+from bench.fake_bot import FakeBot
+from bench.synthetic import make_question_items, make_subscriptions
+
+PG_SCHEMA = """create schema stackexchange_db;
+create table stackexchange_db.subscriptions
+(
+    id serial primary key,
+    telegram_id bigint not null,
+    site_id integer not null,
+    tags_any text[] not null default '{}',
+    tags_all text[] not null default '{}',
+    tags_exclude text[] not null default '{}'
+);
+create index i_subscriptions_site_id on stackexchange_db.subscriptions(site_id);
+create table stackexchange_db.outbox
+(
+    id bigserial primary key,
+    telegram_id bigint not null,
+    site_id integer not null,
+    question_id bigint not null,
+    payload text not null,
+    status_id integer not null default 1,
+    dt_created  timestamp with time zone default current_timestamp
+);
+create unique index u_outbox_telegram_id_question on stackexchange_db.outbox(telegram_id, site_id, question_id);"""
+
+
+def percentile(values: List[float], p: float):
+    """
+    Return the percentile in ms, "-" for no values.
+    """
+    if len(values) == 0:
+        return "-"
+    values = sorted(values)
+    return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 2)
+
+
+def report(stage: str, subs: int, items: int, total: float, latencies: List[float]):
+    print("{:<14} {:>8} {:>9} {:>9} {:>11} {:>9} {:>9}".format(
+        stage, subs, items, round(total, 3), round(items / total) if total > 0 else "-",
+        percentile(latencies, 0.5), percentile(latencies, 0.95)))
+
+
+def fetch(api: ApiClient, sites: List[str], subs: int) -> Dict[str, List]:
+    pages = {site: [] for site in sites}
+    latencies = []
+    cnt = 0
+    started = last = time.perf_counter()
+    for site, page, done, failed in api.stream_questions({site: 0 for site in sites}):
+        now = time.perf_counter()
+        if not done:
+            pages[site].append(page)
+            latencies.append(now - last)
+            cnt += len(page)
+        last = now
+    report("fetch", subs, cnt, time.perf_counter() - started, latencies)
+    return pages
+
+
+def match(registry: MatcherRegistry, site_ids: Dict[str, int], pages: Dict[str, List], engine: str,
+          subs: int) -> Dict[int, List]:
+    matches = {}
+    latencies = []
+    cnt = 0
+    started = time.perf_counter()
+    for site in pages:
+        matcher = registry.get(site_ids[site])
+        if engine == ENGINE_NUMPY:
+            # compiled on first use in production too, it's not a part of the per page cost
+            matcher.match_all_vectorized([])
+        for page in pages[site]:
+            page_started = time.perf_counter()
+            if engine == ENGINE_NUMPY:
+                res = matcher.match_all_vectorized(page)
+            else:
+                res = matcher.match_all(page)
+            latencies.append(time.perf_counter() - page_started)
+            for usr in res:
+                cnt += len(res[usr])
+                matches.setdefault(usr, []).extend(res[usr])
+    report("match " + engine, subs, cnt, time.perf_counter() - started, latencies)
+    return matches
+
+
+def notify(matches: Dict[int, List], args, subs: int):
+    bot = FakeBot(args.bot_latency)
+    put_times = []
+    latencies = []
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def on_delivered(keys: List[int]):
+        now = time.perf_counter()
+        with lock:
+            for key in keys:
+                latencies.append(now - put_times[key])
+            if len(latencies) == len(put_times):
+                done.set()
+
+    notifier = Notifier(bot, logging.getLogger("notifier"), args.notifier_workers, args.global_rate,
+                        args.chat_rate, on_delivered=on_delivered, on_failed=on_delivered)
+    notifier.start()
+    started = time.perf_counter()
+    for usr in matches:
+        items = []
+        for q in matches[usr]:
+            items.append((format_question(q), len(put_times)))
+            put_times.append(time.perf_counter())
+        notifier.put_many(usr, items)
+    if len(put_times) > 0:
+        done.wait()
+    total = time.perf_counter() - started
+    notifier.stop()
+    report("notify", subs, len(put_times), total, latencies)
+    report("notify msgs", subs, bot.sent, total, [])
+
+
+def run_sql(dsn: str, rows: Dict[str, List], site_ids: Dict[str, int], pages: Dict[str, List], subs: int):
+    import psycopg2
+    from psycopg2.extras import execute_values
+    connect = psycopg2.connect(dsn)
+    cur = connect.cursor()
+    # fails if the schema exists, so a real bot database is never touched
+    cur.execute(PG_SCHEMA)
+    try:
+        for site in rows:
+            execute_values(cur, """insert into stackexchange_db.subscriptions(id, telegram_id, site_id, tags_any,
+                                   tags_all, tags_exclude) values %s""",
+                           [(r[0], r[1], site_ids[site], r[2], r[3], r[4]) for r in rows[site]],
+                           template="(%s, %s, %s, %s::text[], %s::text[], %s::text[])", page_size=1000)
+        cur.execute("analyze stackexchange_db.subscriptions")
+        connect.commit()
+        latencies = []
+        cnt = 0
+        started = time.perf_counter()
+        for site in pages:
+            for page in pages[site]:
+                page_started = time.perf_counter()
+                res = match_in_db(cur, site_ids[site], page)
+                save_matches(cur, site_ids[site], res)
+                connect.commit()
+                latencies.append(time.perf_counter() - page_started)
+                for usr in res:
+                    cnt += len(res[usr])
+        report("match " + ENGINE_SQL, subs, cnt, time.perf_counter() - started, latencies)
+    finally:
+        connect.rollback()
+        cur.execute("drop schema if exists stackexchange_db cascade")
+        connect.commit()
+        connect.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch, match and notify benchmark")
+    parser.add_argument("--subs", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--sites", type=int, default=10)
+    parser.add_argument("--questions", type=int, default=1000, help="questions per site")
+    parser.add_argument("--engines", nargs="+", default=[ENGINE_PYTHON, ENGINE_NUMPY],
+                        choices=[ENGINE_PYTHON, ENGINE_NUMPY])
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per API response")
+    parser.add_argument("--api-parallel", type=int, default=8)
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="seconds per sent message")
+    parser.add_argument("--notifier-workers", type=int, default=4)
+    parser.add_argument("--global-rate", type=float, default=1000000, help="messages per second")
+    parser.add_argument("--chat-rate", type=float, default=1000000, help="messages per second to a chat")
+    parser.add_argument("--dsn", help="disposable postgres database for the sql engine")
+    parser.add_argument("--log-level", help="log api and notifier to files in a temporary dir at this level")
+    parser.add_argument("--sync-log", action="store_true", help="write logs in the calling thread")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    api_log = logging.getLogger("api")
+    if args.log_level is not None:
+        log.LOG_DIR = tempfile.mkdtemp(prefix="bench_logs_") + "/"
+        log.set_async(not args.sync_log)
+        api_log = log.get_logger("api", args.log_level, console=False)
+        log.get_logger("notifier", args.log_level, console=False)
+    engines = args.engines
+    if ENGINE_NUMPY in engines and load_numpy() is None:
+        print("numpy isn't installed, {} engine is skipped".format(ENGINE_NUMPY))
+        engines = [i for i in engines if i != ENGINE_NUMPY]
+    sites = ["site{}".format(i) for i in range(args.sites)]
+    site_ids = {site: i + 1 for i, site in enumerate(sites)}
+    questions = {site: make_question_items(args.questions, args.seed + i) for i, site in enumerate(sites)}
+    fake_api = FakeStackExchange(questions, args.api_latency)
+    fake_api.start()
+    api = ApiClient(api_log, args.api_parallel, api_url=fake_api.url)
+    print("{:<14} {:>8} {:>9} {:>9} {:>11} {:>9} {:>9}".format(
+        "stage", "subs", "items", "total s", "items/s", "p50 ms", "p95 ms"))
+    try:
+        for subs in args.subs:
+            rows = make_subscriptions(subs, sites, args.seed)
+            registry = MatcherRegistry()
+            for site in sites:
+                registry.load(site_ids[site], rows[site])
+            pages = fetch(api, sites, subs)
+            matches = {}
+            for engine in engines:
+                matches = match(registry, site_ids, pages, engine, subs)
+            notify(matches, args, subs)
+            if args.dsn is not None:
+                run_sql(args.dsn, rows, site_ids, pages, subs)
+    finally:
+        api.close()
+        fake_api.stop()
+        log.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Synthetic stackexchange data, tag popularity follows zipf law like on real sites: few tags are very common,
+most are rare.
+"""
+import itertools
+import random
+from typing import Dict, List
+
+TAGS = 5000
+ZIPF_EXPONENT = 1.1
+CUM_WEIGHTS = list(itertools.accumulate(1 / (k ** ZIPF_EXPONENT) for k in range(1, TAGS + 1)))
+
+
+def zipf_tags(rnd: random.Random, cnt: int) -> List[str]:
+    return list(set("tag{}".format(k) for k in rnd.choices(range(TAGS), cum_weights=CUM_WEIGHTS, k=cnt)))
+
+
+def make_subscriptions(cnt: int, sites: List[str], seed: int) -> Dict[str, List]:
+    """
+    Return rows shaped as stackexchange_db.subscriptions (id, telegram_id, tags_any, tags_all, tags_exclude)
+    per site, a chat has two subscriptions on average.
+    """
+    rnd = random.Random(seed)
+    res = {site: [] for site in sites}
+    for i in range(cnt):
+        site = sites[min(int(rnd.paretovariate(1.0)) - 1, len(sites) - 1)]
+        res[site].append((i + 1, rnd.randint(1, cnt // 2 + 1), zipf_tags(rnd, rnd.randint(1, 3)),
+                          zipf_tags(rnd, rnd.randint(0, 1)), zipf_tags(rnd, rnd.randint(0, 1))))
+    return res
+
+
+def make_question_items(cnt: int, seed: int, first_id: int = 1) -> List[Dict]:
+    """
+    Return questions as items of the questions API method.
+    """
+    rnd = random.Random(seed)
+    res = []
+    for i in range(cnt):
+        question_id = first_id + i
+        res.append({"title": "Synthetic question {}".format(question_id),
+                    "link": "https://stackoverflow.com/questions/{}".format(question_id),
+                    "question_id": question_id, "creation_date": 1600000000 + question_id,
+                    "tags": zipf_tags(rnd, rnd.randint(1, 5))})
+    return res
@@ -0,0 +1,29 @@
+create table stackexchange_db.outbox_statuses
+(
+    id integer primary key,
+    v_name varchar(255)
+);
+alter table stackexchange_db.outbox_statuses owner to stackexchange_bot;
+insert into stackexchange_db.outbox_statuses (id, v_name) values (1, 'New');
+insert into stackexchange_db.outbox_statuses (id, v_name) values (2, 'Sent');
+insert into stackexchange_db.outbox_statuses (id, v_name) values (3, 'Failed');
+
+create table stackexchange_db.outbox
+(
+    id bigserial primary key,
+    telegram_id bigint not null,
+    site_id integer not null,
+    question_id bigint not null,
+    payload text not null,
+    status_id integer not null default 1,
+    dt_created  timestamp with time zone default current_timestamp,
+    dt_sent  timestamp with time zone
+);
+create unique index u_outbox_telegram_id_question on stackexchange_db.outbox(telegram_id, site_id, question_id);
+create index i_outbox_new on stackexchange_db.outbox(telegram_id, id) where status_id = 1;
+alter table stackexchange_db.outbox ADD CONSTRAINT fk_outbox_to_statuses foreign key (status_id) references  stackexchange_db.outbox_statuses(id);
+alter table stackexchange_db.outbox ADD CONSTRAINT fk_outbox_to_sites foreign key (site_id) references  stackexchange_db.sites(id);
+alter table stackexchange_db.outbox owner to stackexchange_bot;
+
+update stackexchange_db.version set n_version = 2, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
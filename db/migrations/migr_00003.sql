@@ -0,0 +1,8 @@
+insert into stackexchange_db.outbox_statuses (id, v_name) values (4, 'Queued');
+alter table stackexchange_db.outbox add column dt_claimed timestamp with time zone;
+create index i_outbox_queued on stackexchange_db.outbox(dt_claimed) where status_id = 4;
+
+create index i_subscriptions_site_id on stackexchange_db.subscriptions(site_id);
+
+update stackexchange_db.version set n_version = 3, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
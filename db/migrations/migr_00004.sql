@@ -0,0 +1,6 @@
+alter table stackexchange_db.site_updates add column lease_owner varchar(255);
+alter table stackexchange_db.site_updates add column lease_expires timestamp with time zone;
+create index i_site_updates_dt_next_update on stackexchange_db.site_updates(dt_next_update);
+
+update stackexchange_db.version set n_version = 4, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
@@ -0,0 +1,19 @@
+alter table stackexchange_db.subscriptions add column tags_any text[] not null default '{}';
+alter table stackexchange_db.subscriptions add column tags_all text[] not null default '{}';
+alter table stackexchange_db.subscriptions add column tags_exclude text[] not null default '{}';
+
+-- same cleaning as clear_tags, quotes around a tag are dropped
+update stackexchange_db.subscriptions s
+   set tags_any = array(select case when left(t, 1) in ('''', '"') then substr(t, 2, length(t) - 2) else t end
+                       from jsonb_array_elements_text(coalesce(s.tags -> 'tags_any', '[]'::jsonb)) t),
+       tags_all = array(select case when left(t, 1) in ('''', '"') then substr(t, 2, length(t) - 2) else t end
+                       from jsonb_array_elements_text(coalesce(s.tags -> 'tags_all', '[]'::jsonb)) t),
+       tags_exclude = array(select case when left(t, 1) in ('''', '"') then substr(t, 2, length(t) - 2) else t end
+                       from jsonb_array_elements_text(coalesce(s.tags -> 'tags_exclude', '[]'::jsonb)) t);
+
+create index i_subscriptions_tags_any on stackexchange_db.subscriptions using gin(tags_any);
+create index i_subscriptions_tags_all on stackexchange_db.subscriptions using gin(tags_all);
+create index i_subscriptions_tags_exclude on stackexchange_db.subscriptions using gin(tags_exclude);
+
+update stackexchange_db.version set n_version = 5, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
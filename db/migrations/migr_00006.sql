@@ -0,0 +1,6 @@
+alter table stackexchange_db.sites add column site_url varchar(1024);
+alter table stackexchange_db.sites add column audience text;
+alter table stackexchange_db.sites add column site_state varchar(64);
+
+update stackexchange_db.version set n_version = 6, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
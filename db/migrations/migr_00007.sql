@@ -0,0 +1,9 @@
+create index i_subscriptions_telegram_id on stackexchange_db.subscriptions(telegram_id, id);
+
+-- kept by the bot on every insert and delete of subscriptions, admin_stats reads it instead of counting
+alter table stackexchange_db.sites add column n_subscriptions integer not null default 0;
+update stackexchange_db.sites st
+   set n_subscriptions = (select count(1) from stackexchange_db.subscriptions s where s.site_id = st.id);
+
+update stackexchange_db.version set n_version = 7, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
@@ -0,0 +1,5 @@
+-- learned questions per second of the site, kept between polls, restarts and updaters
+alter table stackexchange_db.site_updates add column question_rate double precision;
+
+update stackexchange_db.version set n_version = 8, dt_update = current_timestamp where v_name = 'Stackexchange bot';
+commit;
\ No newline at end of file
@@ -0,0 +1,18 @@
+create table stackexchange_db.outbox
+(
+    id bigserial primary key,
+    telegram_id bigint not null,
+    site_id integer not null,
+    question_id bigint not null,
+    payload text not null,
+    status_id integer not null default 1,
+    dt_created  timestamp with time zone default current_timestamp,
+    dt_sent  timestamp with time zone,
+    dt_claimed  timestamp with time zone
+);
+create unique index u_outbox_telegram_id_question on stackexchange_db.outbox(telegram_id, site_id, question_id);
+create index i_outbox_new on stackexchange_db.outbox(telegram_id, id) where status_id = 1;
+create index i_outbox_queued on stackexchange_db.outbox(dt_claimed) where status_id = 4;
+alter table stackexchange_db.outbox ADD CONSTRAINT fk_outbox_to_statuses foreign key (status_id) references  stackexchange_db.outbox_statuses(id);
+alter table stackexchange_db.outbox ADD CONSTRAINT fk_outbox_to_sites foreign key (site_id) references  stackexchange_db.sites(id);
+alter table stackexchange_db.outbox owner to stackexchange_bot;
\ No newline at end of file
@@ -0,0 +1,10 @@
+create table stackexchange_db.outbox_statuses
+(
+    id integer primary key,
+    v_name varchar(255)
+);
+alter table stackexchange_db.outbox_statuses owner to stackexchange_bot;
+insert into stackexchange_db.outbox_statuses (id, v_name) values (1, 'New');
+insert into stackexchange_db.outbox_statuses (id, v_name) values (2, 'Sent');
+insert into stackexchange_db.outbox_statuses (id, v_name) values (3, 'Failed');
+insert into stackexchange_db.outbox_statuses (id, v_name) values (4, 'Queued');
\ No newline at end of file
@@ -5,9 +5,13 @@ create table stackexchange_db.site_updates
     last_question_id bigint,
     last_question_time bigint,
     dt_next_update timestamp with time zone not null,
-    update_status_id integer
+    update_status_id integer,
+    lease_owner varchar(255),
+    lease_expires timestamp with time zone,
+    question_rate double precision
 );
 create unique index u_site_updates_site_id on stackexchange_db.site_updates(site_id);
+create index i_site_updates_dt_next_update on stackexchange_db.site_updates(dt_next_update);
 alter table stackexchange_db.site_updates ADD CONSTRAINT fk_site_updates_to_statuses foreign key (update_status_id) references  stackexchange_db.update_statuses(id);
 alter table stackexchange_db.site_updates ADD CONSTRAINT fk_site_updates_to_sites foreign key (site_id) references  stackexchange_db.sites(id);
 alter table stackexchange_db.site_updates owner to stackexchange_bot;
\ No newline at end of file
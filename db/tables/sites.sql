@@ -2,6 +2,10 @@ create table stackexchange_db.sites
 (
     id serial primary key,
     api_site_parameter varchar(1024) not null,
+    site_url varchar(1024),
+    audience text,
+    site_state varchar(64),
+    n_subscriptions integer not null default 0,
     dt_created  timestamp with time zone default current_timestamp
 );
 create unique index u_sites_api_site_parameter on stackexchange_db.sites(api_site_parameter);
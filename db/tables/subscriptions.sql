@@ -4,7 +4,15 @@ create table stackexchange_db.subscriptions
     telegram_id bigint not null,
     site_id integer not null,
     tags jsonb,
+    tags_any text[] not null default '{}',
+    tags_all text[] not null default '{}',
+    tags_exclude text[] not null default '{}',
     dt_created  timestamp with time zone default current_timestamp
 );
+create index i_subscriptions_site_id on stackexchange_db.subscriptions(site_id);
+create index i_subscriptions_telegram_id on stackexchange_db.subscriptions(telegram_id, id);
+create index i_subscriptions_tags_any on stackexchange_db.subscriptions using gin(tags_any);
+create index i_subscriptions_tags_all on stackexchange_db.subscriptions using gin(tags_all);
+create index i_subscriptions_tags_exclude on stackexchange_db.subscriptions using gin(tags_exclude);
 alter table stackexchange_db.subscriptions ADD CONSTRAINT fk_subscriptions_to_sites foreign key (site_id) references  stackexchange_db.sites(id);
 alter table stackexchange_db.subscriptions owner to stackexchange_bot;
\ No newline at end of file
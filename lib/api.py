@@ -0,0 +1,323 @@
+import datetime
+import logging
+import re
+import threading
+import time
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .cache import QuestionCache
+from .question import Question
+
+MAX_TRIES = 3
+WAIT_BETWEEN_TRIES = 3
+REQUEST_TIMEOUT = 30
+
+PAGE_SIZE = 100  # Max valid value
+
+DEFAULT_MAX_PARALLEL = 8
+# fetched pages waiting for the matcher, fetch workers block when there are more
+MAX_PAGES_QUEUED = 32
+
+API_URL = "https://api.stackexchange.com/2.3"
+
+# wrapper fields every filter keeps, the rest is dropped by base=none
+WRAPPER_FIELDS = [".items", ".has_more", ".backoff", ".quota_max", ".quota_remaining",
+                  ".error_id", ".error_name", ".error_message"]
+QUESTION_FIELDS = ["question.title", "question.link", "question.question_id", "question.creation_date",
+                   "question.tags"]
+SITE_FIELDS = ["site.api_site_parameter", "site.site_url", "site.audience", "site.site_state"]
+DEFAULT_FILTER = "default"
+
+ERROR_THROTTLE_VIOLATION = 502
+# errors which can't be fixed by repeating the same request
+FATAL_ERRORS = [400, 401, 402, 403, 404, 405, 406]
+# backoff longer than this skips the request instead of blocking a worker
+MAX_BACKOFF_WAIT = 60
+# requests kept in reserve, so a full quota burn by polling doesn't block site list renewal
+DEFAULT_QUOTA_RESERVE = 50
+
+
+class FetchError(Exception):
+    """
+    A page wasn't received: the request failed, was skipped for backoff or the quota ran out.
+    """
+
+
+class ApiClient:
+    """
+    StackExchange API access over one keep-alive session.
+    Sites are polled in parallel, at most max_parallel requests are in flight at once.
+    Every response updates the daily quota and per-method backoff, which are honored before the next request.
+    """
+
+    def __init__(self, logger: Logger, max_parallel: int = DEFAULT_MAX_PARALLEL, question_filter: str = None,
+                 quota_reserve: int = DEFAULT_QUOTA_RESERVE, cache: QuestionCache = None, api_url: str = API_URL):
+        self.logger = logger
+        self.api_url = api_url
+        # questions seen in previous cycles are taken from here instead of being built again
+        self.cache = cache
+        self.max_parallel = max_parallel
+        self.quota_reserve = quota_reserve
+        self.quota_max = None
+        self.quota_remaining = None
+        self.quota_day = datetime.datetime.utcnow().date()
+        self.requests_sent = 0
+        self.backoff_received = 0
+        self.throttled = 0
+        self._backoff_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.question_filter = question_filter
+        self.site_filter = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_parallel)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="api")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def _renew_quota_if_needed(self):
+        # quota is reset at UTC midnight
+        today = datetime.datetime.utcnow().date()
+        if today != self.quota_day:
+            self.quota_day = today
+            self.quota_remaining = self.quota_max
+
+    def is_quota_exhausted(self) -> bool:
+        with self._lock:
+            self._renew_quota_if_needed()
+            return self.quota_remaining is not None and self.quota_remaining <= 0
+
+    def get_backoff(self, method: str) -> float:
+        with self._lock:
+            return max(self._backoff_until.get(method, 0) - time.monotonic(), 0)
+
+    def _set_backoff(self, method: str, seconds: int):
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._backoff_until.get(method, 0):
+                self._backoff_until[method] = until
+
+    def _update_limits(self, method: str, data: Dict):
+        with self._lock:
+            if data.get("quota_remaining") is not None:
+                self.quota_remaining = data.get("quota_remaining")
+                self.quota_max = data.get("quota_max")
+                self.quota_day = datetime.datetime.utcnow().date()
+        if data.get("backoff"):
+            self.logger.info("Received backoff {} for method {}".format(data.get("backoff"), method))
+            with self._lock:
+                self.backoff_received += 1
+            self._set_backoff(method, data.get("backoff"))
+
+    def plan(self, sites: List[str]) -> List[str]:
+        """
+        Choose the sites which can be polled now: nothing while questions are under long backoff,
+        and no more sites than the quota left above the reserve.
+        """
+        if self.get_backoff("questions/unanswered") > MAX_BACKOFF_WAIT:
+            self.logger.info("Skip polling, questions are under backoff for {} seconds".format(
+                round(self.get_backoff("questions/unanswered"))))
+            return []
+        with self._lock:
+            self._renew_quota_if_needed()
+            if self.quota_remaining is None:
+                return sites
+            budget = max(self.quota_remaining - self.quota_reserve, 0)
+        if budget < len(sites):
+            self.logger.warning("Quota left {}, only {} of {} sites will be polled".format(
+                self.quota_remaining, budget, len(sites)))
+        return sites[:budget]
+
+    def call(self, method: str, params: Dict) -> Optional[Dict]:
+        """
+        Send request to the API method and return decoded response, None if it failed.
+        """
+        url = self.api_url + "/" + method
+        cnt = 0
+        while cnt < MAX_TRIES:
+            if self.is_quota_exhausted():
+                self.logger.error("Quota exhausted, request {} skipped".format(method))
+                return None
+            delay = self.get_backoff(method)
+            if delay > MAX_BACKOFF_WAIT:
+                self.logger.info("Request {} skipped because of backoff {}".format(method, round(delay)))
+                return None
+            if delay > 0:
+                self.logger.info("Wait backoff {} for {}".format(round(delay, 1), method))
+                time.sleep(delay)
+                metrics.api_backoff_seconds.inc(delay, method)
+            self.logger.info("Sending request %s for site %s", method, params.get("site"))
+            try:
+                with metrics.api_request_seconds.time(params.get("site") or method):
+                    r = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            except BaseException as err:
+                self.logger.exception(err)
+                cnt += 1
+                time.sleep(WAIT_BETWEEN_TRIES)
+                continue
+            with self._lock:
+                self.requests_sent += 1
+            self.logger.info("Answer on %s for site %s is %s", method, params.get("site"), r.status_code)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                # decoding the whole body isn't free, it's skipped unless it's logged
+                self.logger.debug("Full response on %s is %s", method, r.text)
+            try:
+                data = r.json()
+            except ValueError:
+                data = {}
+            self._update_limits(method, data)
+            if r.status_code == 200:
+                return data
+            error_id = data.get("error_id")
+            self.logger.error("Incorrect response {} {} from {}".format(r.status_code, r.text, url))
+            if error_id == ERROR_THROTTLE_VIOLATION:
+                with self._lock:
+                    self.throttled += 1
+                seconds = re.search(r"(\d+) seconds", data.get("error_message") or "")
+                self._set_backoff(method, int(seconds.group(1)) if seconds else WAIT_BETWEEN_TRIES)
+            elif error_id in FATAL_ERRORS:
+                return None
+            else:
+                time.sleep(WAIT_BETWEEN_TRIES)
+            cnt += 1
+        return None
+
+    def create_filter(self, include: List[str]) -> str:
+        """
+        Build a filter returning only the listed fields, so responses carry nothing Question doesn't need.
+        Filters are immutable on the API side, the result may be put in the config to skip this request.
+        """
+        data = self.call("filters/create", {"include": ";".join(WRAPPER_FIELDS + include), "base": "none",
+                                            "unsafe": "false"})
+        if data is None or len(data.get("items", [])) == 0:
+            return DEFAULT_FILTER
+        res = data.get("items")[0].get("filter")
+        self.logger.info("Created filter {} for fields {}".format(res, include))
+        return res
+
+    def get_question_filter(self) -> str:
+        if self.question_filter is None or self.question_filter == DEFAULT_FILTER:
+            self.question_filter = self.create_filter(QUESTION_FIELDS)
+        return self.question_filter
+
+    def get_site_filter(self) -> str:
+        if self.site_filter is None or self.site_filter == DEFAULT_FILTER:
+            self.site_filter = self.create_filter(SITE_FIELDS)
+        return self.site_filter
+
+    def iter_questions(self, site: str, from_date: int, stop: threading.Event = None) -> Iterator[List[Question]]:
+        """
+        Yield questions page by page, so the caller can process a page before the next one is requested.
+        Raise FetchError if a page isn't received, so a failed poll isn't taken for a site without questions.
+        No more pages are requested once stop is set.
+        """
+        page = 1
+        need_request = True
+        question_filter = self.question_filter
+        if question_filter is None:
+            question_filter = DEFAULT_FILTER
+        while need_request:
+            if stop is not None and stop.is_set():
+                return
+            data = self.call("questions/unanswered", {"order": "desc", "sort": "activity", "site": site,
+                                                      "fromdate": from_date, "pagesize": PAGE_SIZE, "page": page,
+                                                      "filter": question_filter})
+            if data is None:
+                raise FetchError("Page {} of site {} wasn't received".format(page, site))
+            need_request = data.get("has_more")
+            res = []
+            for i in data.get("items"):
+                q = None
+                if self.cache is not None:
+                    q = self.cache.get(site, i.get("question_id"))
+                if q is None:
+                    q = Question(title=i.get("title"), link=i.get("link"), question_id=i.get("question_id"),
+                                 creation_date=i.get("creation_date"),
+                                 tags=i.get("tags"))
+                res.append(q)
+            # the decoded page isn't needed anymore, only questions are kept
+            del data
+            metrics.questions_fetched.inc(len(res), site)
+            page += 1
+            self.logger.info("Need to request more for site %s: %s, next page: %s, page size %s",
+                             site, need_request, page, PAGE_SIZE)
+            yield res
+
+    def _stream_site(self, site: str, from_date: int, pages: Queue, stop: threading.Event):
+        failed = True
+        try:
+            for page in self.iter_questions(site, from_date, stop):
+                pages.put((site, page, False, False))
+            failed = False
+        except FetchError as err:
+            self.logger.warning(str(err))
+        except BaseException as err:
+            self.logger.exception(err)
+        finally:
+            pages.put((site, [], True, failed))
+
+    def stream_questions(self, borders: Dict[str, int]) -> Iterator[Tuple[str, List[Question], bool, bool]]:
+        """
+        Request new questions for all sites at once, borders maps api_site_parameter to fromdate.
+        Yield (site, page, done, failed) as pages arrive, the last item of every site has done set and an empty
+        page, failed tells that not all pages of the site were received.
+        Fetching stops when the caller is MAX_PAGES_QUEUED pages behind, which bounds the memory held.
+        When the caller stops early, workers finish the requests in flight and request nothing more.
+        """
+        # create filter once here instead of racing on it from every worker
+        self.get_question_filter()
+        pages = Queue(maxsize=MAX_PAGES_QUEUED)
+        stop = threading.Event()
+        for site in borders:
+            self._executor.submit(self._stream_site, site, borders[site], pages, stop)
+        left = len(borders)
+        try:
+            while left > 0:
+                site, page, done, failed = pages.get()
+                if done:
+                    left -= 1
+                yield site, page, done, failed
+        finally:
+            # the caller gave up, let workers blocked on the full queue finish
+            stop.set()
+            while left > 0:
+                site, page, done, failed = pages.get()
+                if done:
+                    left -= 1
+
+    def request_sites(self) -> Optional[List[Dict]]:
+        """
+        Return all sites with metadata, None if any page failed, so a partial list is never taken as the catalog.
+        """
+        res = []
+        page = 1
+        need_request = True
+        while need_request:
+            data = self.call("sites", {"filter": self.get_site_filter(), "pagesize": PAGE_SIZE, "page": page})
+            if data is None:
+                return None
+            need_request = data.get("has_more")
+            res.extend(data.get("items"))
+            page += 1
+        return res
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            self._renew_quota_if_needed()
+            stats = {"api_quota_remaining": self.quota_remaining, "api_quota_max": self.quota_max,
+                     "api_requests": self.requests_sent, "api_backoffs": self.backoff_received,
+                     "api_throttled": self.throttled}
+        for method in list(self._backoff_until):
+            delay = self.get_backoff(method)
+            if delay > 0:
+                stats["api_backoff " + method] = round(delay)
+        return stats
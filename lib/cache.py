@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from .question import Question
+
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_CACHE_TTL = 3600
+
+
+class QuestionCache:
+    """
+    Bounded LRU cache of recently processed questions keyed by site and question id.
+    Fetch windows of sequential cycles overlap, questions found here are neither parsed again nor matched again.
+    Entries older than ttl seconds are treated as missing and evicted.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, ttl: int = DEFAULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def configure(self, max_size: int, ttl: int):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._evict()
+
+    def _evict(self):
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def get(self, site: str, question_id: int) -> Optional[Question]:
+        key = (site, question_id)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            added, q = item
+            if time.monotonic() - added > self.ttl:
+                del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return q
+
+    def put_many(self, site: str, questions: Iterable[Question]):
+        now = time.monotonic()
+        with self._lock:
+            for q in questions:
+                key = (site, q.question_id)
+                self._items[key] = (now, q)
+                self._items.move_to_end(key)
+            self._evict()
+
+    def drop_known(self, site: str, questions: List[Question]) -> List[Question]:
+        """
+        Return questions not processed yet.
+        """
+        res = []
+        now = time.monotonic()
+        with self._lock:
+            for q in questions:
+                item = self._items.get((site, q.question_id))
+                if item is None or now - item[0] > self.ttl:
+                    res.append(q)
+        return res
+
+    def get_stats(self) -> Dict:
+        return {"question_cache_size": len(self._items), "question_cache_hits": self.hits,
+                "question_cache_misses": self.misses}
+
+
+DEFAULT_CHAT_CACHE_SIZE = 10000
+# subscriptions of a blocked chat are deleted by the worker, stale lists live not longer than this in other processes
+DEFAULT_CHAT_CACHE_TTL = 300
+
+
+class SubscriptionCache:
+    """
+    Small LRU cache of subscription lists per chat for /list and /del, dropped by every change of the chat.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CHAT_CACHE_SIZE, ttl: int = DEFAULT_CHAT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id: int) -> Optional[List]:
+        with self._lock:
+            item = self._items.get(telegram_id)
+            if item is None:
+                return None
+            added, subs = item
+            if time.monotonic() - added > self.ttl:
+                del self._items[telegram_id]
+                return None
+            self._items.move_to_end(telegram_id)
+            return subs
+
+    def put(self, telegram_id: int, subs: List):
+        with self._lock:
+            self._items[telegram_id] = (time.monotonic(), subs)
+            self._items.move_to_end(telegram_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._items.pop(telegram_id, None)
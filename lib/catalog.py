@@ -0,0 +1,105 @@
+import threading
+from logging import Logger
+from typing import Dict, List, Optional
+
+from psycopg2.extras import execute_values
+
+# other states from the API are open_beta, closed_beta and linked_meta
+SITE_STATE_NORMAL = "normal"
+
+
+class SiteInfo:
+    __slots__ = ("name", "site_id", "site_url", "audience", "state")
+
+    def __init__(self, name: str, site_id: int, site_url: str = None, audience: str = None, state: str = None):
+        self.name = name
+        self.site_id = site_id
+        self.site_url = site_url
+        self.audience = audience
+        self.state = state
+
+    def same_as(self, item: Dict) -> bool:
+        return (self.site_url == item.get("site_url") and self.audience == item.get("audience")
+                and self.state == item.get("site_state"))
+
+    def is_normal(self) -> bool:
+        # unknown until the first sync with the API
+        return self.state is None or self.state == SITE_STATE_NORMAL
+
+
+class SiteCatalog:
+    """
+    In-memory copy of stackexchange_db.sites with metadata from the API.
+    Readers never lock: the dict is replaced as a whole on every change.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self._sites: Dict[str, SiteInfo] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sites
+
+    def __len__(self):
+        return len(self._sites)
+
+    def get(self, name: str) -> Optional[SiteInfo]:
+        return self._sites.get(name)
+
+    def get_id(self, name: str) -> Optional[int]:
+        site = self._sites.get(name)
+        if site is None:
+            return None
+        return site.site_id
+
+    def names(self) -> List[str]:
+        return list(self._sites)
+
+    def apply(self, rows):
+        with self._lock:
+            sites = dict(self._sites)
+            for site_id, name, site_url, audience, state in rows:
+                sites[name] = SiteInfo(name, site_id, site_url, audience, state)
+            self._sites = sites
+
+    def load(self, cur):
+        cur.execute("""select id, api_site_parameter, site_url, audience, site_state from stackexchange_db.sites""")
+        self.apply(cur.fetchall())
+
+    def find(self, cur, name: str) -> Optional[int]:
+        """
+        Return id of the site, looking in the table for sites added by another process since the last sync.
+        """
+        site_id = self.get_id(name)
+        if site_id is not None:
+            return site_id
+        cur.execute("""select id, api_site_parameter, site_url, audience, site_state from stackexchange_db.sites
+                       where api_site_parameter = %s""", (name,))
+        rows = cur.fetchall()
+        self.apply(rows)
+        return self.get_id(name)
+
+    def sync(self, cur, items: List[Dict]) -> List:
+        """
+        Write sites returned by the API: new and changed ones by one upsert, the rest is untouched.
+        Sites gone from the API are kept, subscriptions reference them. Return the written rows, they have to be
+        passed to apply after the commit, so ids of a rolled back upsert never get to the catalog.
+        """
+        changed = []
+        for i in items:
+            site = self._sites.get(i.get("api_site_parameter"))
+            if site is None or not site.same_as(i):
+                changed.append((i.get("api_site_parameter"), i.get("site_url"), i.get("audience"),
+                                i.get("site_state")))
+        if len(changed) == 0:
+            return []
+        rows = execute_values(cur, """insert into stackexchange_db.sites(api_site_parameter, site_url, audience,
+                                      site_state) values %s
+                                      on conflict (api_site_parameter) do update
+                                      set site_url = excluded.site_url, audience = excluded.audience,
+                                      site_state = excluded.site_state
+                                      returning id, api_site_parameter, site_url, audience, site_state""",
+                              changed, page_size=1000, fetch=True)
+        self.logger.info("Site catalog: {} sites added or changed".format(len(rows)))
+        return rows
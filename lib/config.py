@@ -1,6 +1,8 @@
 import codecs
 import datetime
 import json
+import os
+import socket
 
 from .security import is_password_encrypted, encrypt_password, decrypt_password
 from .log import get_logger
@@ -19,6 +21,46 @@ CONFIG_PARAM_SERVER_NAME = "SERVER_NAME"
 CONFIG_PARAM_HALT_ON_ERRORS = "HALT_ON_ERRORS"
 CONFIG_PARAM_BOT_SECRET = "BOT_SECRET"
 CONFIG_PARAM_ADMIN_LIST = "ADMIN_ACCOUNTS"
+CONFIG_PARAM_API_MAX_PARALLEL = "API_MAX_PARALLEL"
+CONFIG_PARAM_API_FILTER = "API_FILTER"
+CONFIG_PARAM_API_QUOTA_RESERVE = "API_QUOTA_RESERVE"
+CONFIG_PARAM_POLL_INTERVAL_MIN = "POLL_INTERVAL_MIN"
+CONFIG_PARAM_POLL_INTERVAL_MAX = "POLL_INTERVAL_MAX"
+CONFIG_PARAM_NOTIFIER_WORKERS = "NOTIFIER_WORKERS"
+CONFIG_PARAM_TELEGRAM_GLOBAL_RATE = "TELEGRAM_GLOBAL_RATE"
+CONFIG_PARAM_TELEGRAM_CHAT_RATE = "TELEGRAM_CHAT_RATE"
+CONFIG_PARAM_DB_POOL_MIN = "DB_POOL_MIN"
+CONFIG_PARAM_DB_POOL_MAX = "DB_POOL_MAX"
+CONFIG_PARAM_NODE_NAME = "NODE_NAME"
+CONFIG_PARAM_LEASE_TIME = "LEASE_TIME"
+CONFIG_PARAM_UPDATER_BATCH = "UPDATER_BATCH"
+CONFIG_PARAM_MATCH_ENGINE = "MATCH_ENGINE"
+CONFIG_PARAM_DIGEST_PER_CYCLE = "DIGEST_PER_CYCLE"
+CONFIG_PARAM_QUESTION_CACHE_SIZE = "QUESTION_CACHE_SIZE"
+CONFIG_PARAM_QUESTION_CACHE_TTL = "QUESTION_CACHE_TTL"
+CONFIG_PARAM_METRICS_PORT = "METRICS_PORT"
+CONFIG_PARAM_DB_WAIT_TIMEOUT = "DB_WAIT_TIMEOUT"
+CONFIG_PARAM_LOG_RATE_LIMIT = "LOG_RATE_LIMIT"
+
+DEFAULT_API_MAX_PARALLEL = 8
+DEFAULT_API_QUOTA_RESERVE = 50
+DEFAULT_POLL_INTERVAL_MIN = 60
+DEFAULT_POLL_INTERVAL_MAX = 3600
+DEFAULT_NOTIFIER_WORKERS = 4
+DEFAULT_TELEGRAM_GLOBAL_RATE = 30
+DEFAULT_TELEGRAM_CHAT_RATE = 1
+DEFAULT_DB_POOL_MIN = 1
+DEFAULT_DB_POOL_MAX = 10
+DEFAULT_LEASE_TIME = 120
+DEFAULT_UPDATER_BATCH = 50
+DEFAULT_MATCH_ENGINE = "python"
+DEFAULT_QUESTION_CACHE_SIZE = 100000
+DEFAULT_QUESTION_CACHE_TTL = 3600
+DEFAULT_DB_WAIT_TIMEOUT = 120
+DEFAULT_LOG_RATE_LIMIT = 20
+DEFAULT_CONFIG_RELOAD_TIME = 1
+# a change of any of these needs a new connection pool
+DB_CREDENTIALS = ["db_name", "db_host", "db_port", "db_user", "db_password"]
 
 MODE_CORE = "core"
 MODE_BOT = "bot"
@@ -28,9 +70,8 @@ MODE_UPDATER = "updater"
 
 class Config:
     def __init__(self, file: str, reload: bool = False):
-        f = file
-        fp = codecs.open(f, 'r', "utf-8")
-        config = json.load(fp)
+        with codecs.open(file, 'r', "utf-8") as fp:
+            config = json.load(fp)
         if not reload:
             self.logger = get_logger(LOG_CONFIG, is_system=True)
             set_startup()
@@ -51,8 +92,10 @@ class Config:
         self.db_password_read = config.get(CONFIG_PARAM_DB_PASSWORD)
         if config.get(CONFIG_PARAM_NEW_PATH) is not None:
             self.file_path = config.get(CONFIG_PARAM_NEW_PATH)
-        self.reload_time = config.get(CONFIG_PARAM_CONFIG_RELOAD_TIME)
-        self.next_reload = datetime.datetime.now()
+        # minutes between checks of the settings file
+        self.reload_time = config.get(CONFIG_PARAM_CONFIG_RELOAD_TIME, DEFAULT_CONFIG_RELOAD_TIME)
+        self.next_reload = datetime.datetime.now() + datetime.timedelta(
+            minutes=self.reload_time or DEFAULT_CONFIG_RELOAD_TIME)
         self.reloaded = False
         self.db_credential_changed = False
 
@@ -77,6 +120,36 @@ class Config:
             self.logger.info("Secret was encrypted and saved")
 
         self.admin_list = config.get(CONFIG_PARAM_ADMIN_LIST)
+        self.api_max_parallel = config.get(CONFIG_PARAM_API_MAX_PARALLEL, DEFAULT_API_MAX_PARALLEL)
+        self.api_filter = config.get(CONFIG_PARAM_API_FILTER)
+        self.api_quota_reserve = config.get(CONFIG_PARAM_API_QUOTA_RESERVE, DEFAULT_API_QUOTA_RESERVE)
+        self.poll_interval_min = config.get(CONFIG_PARAM_POLL_INTERVAL_MIN, DEFAULT_POLL_INTERVAL_MIN)
+        self.poll_interval_max = config.get(CONFIG_PARAM_POLL_INTERVAL_MAX, DEFAULT_POLL_INTERVAL_MAX)
+        self.notifier_workers = config.get(CONFIG_PARAM_NOTIFIER_WORKERS, DEFAULT_NOTIFIER_WORKERS)
+        self.telegram_global_rate = config.get(CONFIG_PARAM_TELEGRAM_GLOBAL_RATE, DEFAULT_TELEGRAM_GLOBAL_RATE)
+        self.telegram_chat_rate = config.get(CONFIG_PARAM_TELEGRAM_CHAT_RATE, DEFAULT_TELEGRAM_CHAT_RATE)
+        self.db_pool_min = config.get(CONFIG_PARAM_DB_POOL_MIN, DEFAULT_DB_POOL_MIN)
+        self.db_pool_max = config.get(CONFIG_PARAM_DB_POOL_MAX, DEFAULT_DB_POOL_MAX)
+        self.node_name = config.get(CONFIG_PARAM_NODE_NAME)
+        if self.node_name is None:
+            self.node_name = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lease_time = config.get(CONFIG_PARAM_LEASE_TIME, DEFAULT_LEASE_TIME)
+        self.updater_batch = config.get(CONFIG_PARAM_UPDATER_BATCH, DEFAULT_UPDATER_BATCH)
+        self.match_engine = config.get(CONFIG_PARAM_MATCH_ENGINE, DEFAULT_MATCH_ENGINE)
+        # one digest per chat after all sites of a cycle holds in core mode only, a separate worker sends
+        # a digest per finished site update
+        self.digest_per_cycle = True
+        if config.get(CONFIG_PARAM_DIGEST_PER_CYCLE) is False:
+            self.digest_per_cycle = False
+        self.question_cache_size = config.get(CONFIG_PARAM_QUESTION_CACHE_SIZE, DEFAULT_QUESTION_CACHE_SIZE)
+        self.question_cache_ttl = config.get(CONFIG_PARAM_QUESTION_CACHE_TTL, DEFAULT_QUESTION_CACHE_TTL)
+        # metrics endpoint is off unless a port is set
+        self.metrics_port = config.get(CONFIG_PARAM_METRICS_PORT)
+        self.db_wait_timeout = config.get(CONFIG_PARAM_DB_WAIT_TIMEOUT, DEFAULT_DB_WAIT_TIMEOUT)
+        # same message template is logged not more often than this per second, 0 turns the limit off
+        self.log_rate_limit = config.get(CONFIG_PARAM_LOG_RATE_LIMIT, DEFAULT_LOG_RATE_LIMIT)
+        # taken after the encrypted password and secret were saved back
+        self.file_mtime = os.path.getmtime(file)
 
     def _save_db_password(self, password: str):
         fp = codecs.open(self.file_path, 'r', "utf-8")
@@ -97,22 +170,43 @@ class Config:
         fp.close()
 
     def renew_if_needed(self):
-        if datetime.datetime.now() >= self.next_reload:
-            self.logger.debug("Time to reload settings")
-            old_file_path = self.old_file_path
-            old_db_password = self.db_password
-            try:
-                self.__init__(self.file_path, reload=True)
-                self.reloaded = True
-                if self.db_password != old_db_password:
-                    self.logger.info("DB password changed, need to reconnect")
-                    self.db_credential_changed = True
-            except BaseException as exc:
-                self.logger.critical("Can't reload settings from new path {0}, error {1}".format(self.file_path, exc))
-                self.old_file_path = old_file_path
-                self.file_path = old_file_path
-        else:
+        """
+        Every reload_time minutes check the settings file and read it again if it was changed.
+        Settings are replaced only when the whole file was read, a broken file leaves the old ones in place.
+        """
+        if datetime.datetime.now() < self.next_reload:
             self.logger.debug("Too early to reload settings")
+            return
+        self.next_reload = datetime.datetime.now() + datetime.timedelta(
+            minutes=self.reload_time or DEFAULT_CONFIG_RELOAD_TIME)
+        try:
+            mtime = os.path.getmtime(self.file_path)
+        except OSError as exc:
+            self.logger.error("Can't check settings file {0}, error {1}".format(self.file_path, exc))
+            return
+        if self.file_path == self.old_file_path and mtime == self.file_mtime:
+            self.logger.debug("Settings file not changed")
+            return
+        self.logger.debug("Time to reload settings")
+        # a broken file is read again only after the next change
+        self.file_mtime = mtime
+        try:
+            new = Config.__new__(Config)
+            new.logger = self.logger
+            new.__init__(self.file_path, reload=True)
+        except BaseException as exc:
+            self.logger.critical("Can't reload settings from new path {0}, error {1}".format(self.file_path, exc))
+            self.file_path = self.old_file_path
+            return
+        db_changed = False
+        for i in DB_CREDENTIALS:
+            if getattr(new, i) != getattr(self, i):
+                db_changed = True
+        self.__dict__.update(new.__dict__)
+        self.reloaded = True
+        if db_changed:
+            self.logger.info("DB credentials changed, need to reconnect")
+            self.db_credential_changed = True
 
     def mark_reload_finish(self):
         self.reloaded = False
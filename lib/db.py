@@ -0,0 +1,179 @@
+import threading
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Dict
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from . import metrics
+from .config import Config
+
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+DEFAULT_WAIT_TIMEOUT = 120
+MAX_WAIT_DELAY = 5
+
+
+class Database:
+    """
+    Thread-safe pool of connections, every caller borrows its own connection for a short scope.
+    Broken connections are closed instead of being returned, so the next borrower gets a fresh one.
+    """
+
+    def __init__(self, cfg: Config, logger: Logger, min_size: int = DEFAULT_POOL_MIN,
+                 max_size: int = DEFAULT_POOL_MAX):
+        self.logger = logger
+        self.min_size = min_size
+        self.max_size = max_size
+        self._cfg = cfg
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # pool: connections borrowed from it, a replaced pool is closed when the last one is given back
+        self._borrowed: Dict[ThreadedConnectionPool, int] = {}
+
+    def _create_pool(self, min_size: int = None, max_size: int = None) -> ThreadedConnectionPool:
+        cfg = self._cfg
+        if max_size is None:
+            min_size = self.min_size
+            max_size = self.max_size
+        return ThreadedConnectionPool(min_size, max_size, dbname=cfg.db_name, user=cfg.db_user,
+                                      password=cfg.db_password, host=cfg.db_host, port=cfg.db_port)
+
+    def connect(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._create_pool()
+                self.logger.info("Connection pool created, size {}-{}".format(self.min_size, self.max_size))
+
+    def wait(self, timeout: float = DEFAULT_WAIT_TIMEOUT):
+        """
+        Connect, retrying while the server doesn't accept connections yet, e.g. it's started together with the bot.
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.5
+        while True:
+            try:
+                self.connect()
+                return
+            except psycopg2.OperationalError as err:
+                if time.monotonic() + delay > deadline:
+                    raise
+                self.logger.info("Database isn't available yet, retry in {} seconds: {}".format(delay, err))
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_WAIT_DELAY)
+
+    def reconnect(self, cfg: Config = None):
+        """
+        Replace the pool, connections borrowed from the old one are closed when they are given back,
+        so running transactions finish on them.
+        """
+        if cfg is not None:
+            self._cfg = cfg
+        self._replace(self._create_pool())
+
+    def configure(self, min_size: int, max_size: int):
+        """
+        Resize the pool, a new pool is created when the size was changed.
+        Nothing is changed if the new pool can't be created, so the next call tries again.
+        """
+        if min_size == self.min_size and max_size == self.max_size:
+            return
+        new_pool = None
+        if self._pool is not None:
+            new_pool = self._create_pool(min_size, max_size)
+        self._replace(new_pool, min_size, max_size)
+
+    def _replace(self, new_pool: ThreadedConnectionPool, min_size: int = None, max_size: int = None):
+        with self._lock:
+            if max_size is not None:
+                self.min_size = min_size
+                self.max_size = max_size
+                # borrowers of the old pool give slots back to the old semaphore
+                self._slots = threading.BoundedSemaphore(max_size)
+            if new_pool is None:
+                return
+            old_pool = self._pool
+            self._pool = new_pool
+            idle = old_pool is not None and old_pool not in self._borrowed
+        if idle:
+            old_pool.closeall()
+        self.logger.info("Connection pool recreated, size {}-{}".format(self.min_size, self.max_size))
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def _get(self):
+        self.connect()
+        with self._lock:
+            pool = self._pool
+            self._borrowed[pool] = self._borrowed.get(pool, 0) + 1
+        try:
+            conn = pool.getconn()
+            if conn.closed:
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except BaseException:
+            self._release(pool)
+            raise
+        return pool, conn
+
+    def _put(self, pool: ThreadedConnectionPool, conn, broken: bool):
+        try:
+            if pool.closed:
+                conn.close()
+            else:
+                pool.putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            self._release(pool)
+
+    def _release(self, pool: ThreadedConnectionPool):
+        with self._lock:
+            self._borrowed[pool] -= 1
+            if self._borrowed[pool] > 0:
+                return
+            del self._borrowed[pool]
+            retired = pool is not self._pool
+        if retired and not pool.closed:
+            pool.closeall()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection, it's committed on exit and rolled back on error.
+        """
+        slots = self._slots
+        slots.acquire()
+        started = time.perf_counter()
+        try:
+            pool, conn = self._get()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._put(pool, conn, broken)
+        finally:
+            slots.release()
+            metrics.db_transaction_seconds.observe(time.perf_counter() - started)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
@@ -0,0 +1,65 @@
+import threading
+from logging import Logger
+from typing import List
+
+from .db import Database
+
+DEFAULT_LEASE_TIME = 120
+
+
+class LeaseKeeper:
+    """
+    Renews leases of the site_updates rows this node works on, so they aren't reclaimed while the work goes on.
+    A lease of a node which stopped renewing it expires after lease_time seconds and the site is claimed by others.
+    """
+
+    def __init__(self, db: Database, owner: str, logger: Logger, lease_time: int = DEFAULT_LEASE_TIME):
+        self.db = db
+        self.owner = owner
+        self.logger = logger
+        self.lease_time = lease_time
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name="lease-keeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def hold(self, ids: List[int]):
+        with self._lock:
+            self._held.update(ids)
+
+    def release(self, update_id: int):
+        with self._lock:
+            self._held.discard(update_id)
+
+    def renew(self):
+        with self._lock:
+            ids = list(self._held)
+        if len(ids) == 0:
+            return
+        with self.db.transaction() as cur:
+            cur.execute("""update stackexchange_db.site_updates u
+                           set lease_expires = statement_timestamp() + make_interval(secs => %s)
+                           where u.id = any(%s) and u.lease_owner = %s
+                           returning u.id""", (self.lease_time, ids, self.owner))
+            renewed = set(i for i, in cur.fetchall())
+        lost = set(ids).difference(renewed)
+        if len(lost) > 0:
+            self.logger.warning("Leases for updates {} were lost".format(lost))
+            with self._lock:
+                self._held.difference_update(lost)
+
+    def _work(self):
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                self.renew()
+            except BaseException as err:
+                self.logger.exception(err)
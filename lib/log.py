@@ -1,11 +1,19 @@
+import atexit
 import logging
+import queue
 import sys
-from logging import INFO, Logger, StreamHandler
-from logging.handlers import RotatingFileHandler
-from typing import Union
+import threading
+import time
+from logging import INFO, Handler, Logger, LogRecord, StreamHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Union
 
 FORMATTER = logging.Formatter("[%(levelname)s] [%(name)s] - [%(asctime)s]: %(message)s")
 LOG_DIR = "logs//"
+# records of one message template passed per second and logger, the rest are counted and dropped
+DEFAULT_RATE_LIMIT = 20
+# templates tracked by a filter, messages formatted in place make a new template each, old ones are dropped
+MAX_TEMPLATES = 1000
 
 
 def get_console_handler(is_system: bool = False) -> StreamHandler:
@@ -24,15 +32,131 @@ def get_file_handler(logger_name: str) -> RotatingFileHandler:
     return file_handler
 
 
-def get_logger(logger_name: str, level: Union[int, str] = INFO, is_system: bool = False) -> Logger:
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most rate records per second for every message template of the logger, warnings and errors
+    always pass. The first record passed after a drop tells how many were suppressed.
+    Templates are the unformatted messages, so hot loops should log with lazy %s arguments.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        # template: [window start, passed in window, suppressed]
+        self._windows: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = str(record.msg)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None and len(self._windows) >= MAX_TEMPLATES:
+                self._windows = {k: v for k, v in self._windows.items() if now - v[0] < 1}
+            if window is None or now - window[0] >= 1:
+                suppressed = window[2] if window is not None else 0
+                window = [now, 0, 0]
+                self._windows[key] = window
+                if suppressed > 0:
+                    record.msg = str(record.msg) + " ({} similar messages suppressed)".format(suppressed)
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Puts records to the queue as they are, message formatting is left to the listener thread.
+    """
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        return record
+
+
+class _RoutingHandler(Handler):
+    """
+    Passes a record to the handlers of its logger, so one listener thread serves all loggers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.routes: Dict[str, List[Handler]] = {}
+
+    def handle(self, record: LogRecord) -> bool:
+        for h in self.routes.get(record.name, []):
+            if record.levelno >= h.level:
+                h.handle(record)
+        return True
+
+
+_queue = queue.SimpleQueue()
+_router = _RoutingHandler()
+_listener = None
+_listener_lock = threading.Lock()
+is_async = True
+
+
+def _start_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = QueueListener(_queue, _router)
+            _listener.start()
+            atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Write out queued records and stop the listener thread.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def set_async(enabled: bool):
+    """
+    Choose for loggers created after the call: console and file writes in the listener thread or in the caller.
+    """
+    global is_async
+    is_async = enabled
+
+
+def get_logger(logger_name: str, level: Union[int, str] = INFO, is_system: bool = False,
+               rate_limit: float = DEFAULT_RATE_LIMIT, console: bool = True) -> Logger:
     logger = logging.getLogger(logger_name)
     logger.setLevel(level)
-    logger.addHandler(get_console_handler(is_system))
-    logger.addHandler(get_file_handler(logger_name))
+    handlers = [get_file_handler(logger_name)]
+    if console:
+        handlers.append(get_console_handler(is_system))
+    if is_async:
+        _router.routes.setdefault(logger_name, []).extend(handlers)
+        _start_listener()
+        logger.addHandler(_LazyQueueHandler(_queue))
+    else:
+        for h in handlers:
+            logger.addHandler(h)
+    logger.addFilter(RateLimitFilter(rate_limit))
     # with this pattern, it's rarely necessary to propagate the error up to parent
     logger.propagate = False
     return logger
 
+
+def configure_logger(logger: Logger, level: Union[int, str], rate_limit: float = DEFAULT_RATE_LIMIT):
+    """
+    Change level and rate limit of a logger made by get_logger, e.g. after settings were reloaded.
+    """
+    logger.setLevel(level)
+    for f in logger.filters:
+        if isinstance(f, RateLimitFilter):
+            f.rate = rate_limit
+
 # def set_basic_logging(logger_name: str, level: Union[int, str] = INFO):
 #     logging.basicConfig(format=FORMATTER,
 #                         level=level,
@@ -0,0 +1,371 @@
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from .question import Question, intern_tags
+
+ENGINE_PYTHON = "python"
+ENGINE_SQL = "sql"
+ENGINE_NUMPY = "numpy"
+
+# numpy is optional, it's imported on the first use of the numpy engine
+_numpy = None
+
+
+def load_numpy():
+    """
+    Return the numpy module or None if it isn't installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def clear_tags(list_with_q: List) -> List:
+    res = []
+    for i in list_with_q:
+        if i[0] == "'":
+            res.append(i[1:len(i) - 1])
+        elif i[0] == '"':
+            res.append(i[1:len(i) - 1])
+        else:
+            res.append(i)
+    return res
+
+
+class Subscription:
+    """
+    Tags are stored cleaned by the add command, so they are used as is.
+    """
+    __slots__ = ("id", "telegram_id", "tags_any", "tags_all", "tags_exclude")
+
+    def __init__(self, sub_id: int, telegram_id: int, tags_any: List[str], tags_all: List[str],
+                 tags_exclude: List[str]):
+        self.id = sub_id
+        self.telegram_id = telegram_id
+        self.tags_any = intern_tags(tags_any or [])
+        self.tags_all = intern_tags(tags_all or [])
+        self.tags_exclude = intern_tags(tags_exclude or [])
+
+
+class TagMatcher:
+    """
+    Compiled subscriptions of one site.
+    Every subscription is posted under its tags_any and tags_all tags, so a question only touches subscriptions
+    sharing at least one tag with it. tags_all rules are checked by counting hits against the rule size.
+    """
+
+    def __init__(self, site_id: int, signature: Tuple = None):
+        self.site_id = site_id
+        # subscriptions count and max id at load time, a change of either means the table was changed
+        self.signature = signature
+        self._subs: Dict[int, Subscription] = {}
+        self._any_index: Dict[str, Set[int]] = {}
+        self._all_index: Dict[str, Set[int]] = {}
+        self._exclude_index: Dict[str, Set[int]] = {}
+        # subscriptions of a chat, so a blocked chat is dropped without a scan
+        self._chat_index: Dict[int, Set[int]] = {}
+        self._lock = threading.RLock()
+        # compiled by the numpy engine on demand, dropped on every change
+        self._arrays = None
+        # subscriptions and chats removed while the matcher is filled from a table snapshot,
+        # the snapshot may be older than the removal
+        self._removed: Set[int] = None
+        self._removed_chats: Set[int] = None
+
+    def __len__(self):
+        return len(self._subs)
+
+    @staticmethod
+    def _post(index: Dict[str, Set[int]], tags: Iterable[str], sub_id: int):
+        for t in tags:
+            if t not in index:
+                index[t] = set()
+            index[t].add(sub_id)
+
+    @staticmethod
+    def _unpost(index: Dict[str, Set[int]], tags: Iterable[str], sub_id: int):
+        for t in tags:
+            posting = index.get(t)
+            if posting is None:
+                continue
+            posting.discard(sub_id)
+            if len(posting) == 0:
+                del index[t]
+
+    def add(self, sub_id: int, telegram_id: int, tags_any: List[str], tags_all: List[str],
+            tags_exclude: List[str]):
+        sub = Subscription(sub_id, telegram_id, tags_any, tags_all, tags_exclude)
+        with self._lock:
+            self._drop(sub_id)
+            self._subs[sub_id] = sub
+            self._arrays = None
+            self._post(self._chat_index, [telegram_id], sub_id)
+            self._post(self._any_index, sub.tags_any, sub_id)
+            self._post(self._all_index, sub.tags_all, sub_id)
+            self._post(self._exclude_index, sub.tags_exclude, sub_id)
+
+    def _drop(self, sub_id: int):
+        sub = self._subs.pop(sub_id, None)
+        if sub is None:
+            return
+        self._arrays = None
+        self._unpost(self._chat_index, [sub.telegram_id], sub_id)
+        self._unpost(self._any_index, sub.tags_any, sub_id)
+        self._unpost(self._all_index, sub.tags_all, sub_id)
+        self._unpost(self._exclude_index, sub.tags_exclude, sub_id)
+
+    def remove(self, sub_id: int):
+        with self._lock:
+            if self._removed is not None:
+                self._removed.add(sub_id)
+            self._drop(sub_id)
+
+    def remove_chat(self, telegram_id: int):
+        with self._lock:
+            if self._removed_chats is not None:
+                self._removed_chats.add(telegram_id)
+            for sub_id in list(self._chat_index.get(telegram_id, [])):
+                self._drop(sub_id)
+
+    def start_fill(self):
+        with self._lock:
+            self._removed = set()
+            self._removed_chats = set()
+
+    def fill(self, rows: Iterable):
+        """
+        Add subscriptions read from the table after start_fill, skipping ones removed since then.
+        """
+        for sub_id, telegram_id, tags_any, tags_all, tags_exclude in rows:
+            with self._lock:
+                if sub_id in self._removed or telegram_id in self._removed_chats:
+                    continue
+                self.add(sub_id, telegram_id, tags_any, tags_all, tags_exclude)
+        with self._lock:
+            self._removed = None
+            self._removed_chats = None
+
+    def match(self, question: Question) -> Set[int]:
+        any_hits = set()
+        all_hits = {}
+        excluded = set()
+        with self._lock:
+            for t in question.tags:
+                posting = self._any_index.get(t)
+                if posting is not None:
+                    any_hits.update(posting)
+                posting = self._all_index.get(t)
+                if posting is not None:
+                    for sub_id in posting:
+                        all_hits[sub_id] = all_hits.get(sub_id, 0) + 1
+                posting = self._exclude_index.get(t)
+                if posting is not None:
+                    excluded.update(posting)
+            res = set()
+            for sub_id in any_hits.union(all_hits):
+                if sub_id in excluded:
+                    continue
+                sub = self._subs[sub_id]
+                if sub.telegram_id in res:
+                    continue
+                if len(sub.tags_any) > 0 and sub_id not in any_hits:
+                    continue
+                if all_hits.get(sub_id, 0) < len(sub.tags_all):
+                    continue
+                res.add(sub.telegram_id)
+        return res
+
+    def match_all(self, questions: List[Question]) -> Dict[int, List[Question]]:
+        res = {}
+        for q in questions:
+            for usr in self.match(q):
+                if usr not in res:
+                    res[usr] = []
+                res[usr].append(q)
+        return res
+
+    def match_all_vectorized(self, questions: List[Question]) -> Dict[int, List[Question]]:
+        """
+        Same as match_all, evaluated by ArrayMatcher, numpy has to be installed.
+        """
+        with self._lock:
+            if self._arrays is None:
+                self._arrays = ArrayMatcher(self._subs.values())
+            arrays = self._arrays
+        return arrays.match_all(questions)
+
+
+class ArrayMatcher:
+    """
+    Subscriptions of a site compiled to numpy arrays: per tag posting arrays of subscription numbers and per
+    subscription rule sizes and chats. A batch of questions is matched by set operations over sorted arrays of
+    (question, subscription) pairs, without a Python loop over subscriptions.
+    Wins over TagMatcher when questions touch a large part of subscriptions, e.g. many subscribers of popular tags.
+    """
+
+    def __init__(self, subs: Iterable[Subscription]):
+        np = load_numpy()
+        subs = list(subs)
+        self.size = len(subs)
+        self.any_index = self._compile(np, [sub.tags_any for sub in subs])
+        self.all_index = self._compile(np, [sub.tags_all for sub in subs])
+        self.exclude_index = self._compile(np, [sub.tags_exclude for sub in subs])
+        self.all_size = np.array([len(sub.tags_all) for sub in subs], dtype=np.int64)
+        self.any_empty = np.array([len(sub.tags_any) == 0 for sub in subs], dtype=bool)
+        self.chats, self.chat_index = np.unique(np.array([sub.telegram_id for sub in subs], dtype=np.int64),
+                                                return_inverse=True)
+
+    @staticmethod
+    def _compile(np, rules: List[frozenset]) -> Dict:
+        index = {}
+        for col, tags in enumerate(rules):
+            for t in tags:
+                if t not in index:
+                    index[t] = []
+                index[t].append(col)
+        return {t: np.array(cols, dtype=np.int64) for t, cols in index.items()}
+
+    def _pairs(self, np, index: Dict, questions: List[Question]):
+        """
+        Return sorted unique row * size + subscription keys of all hits and the number of hits of every key.
+        """
+        parts = []
+        for row, q in enumerate(questions):
+            for t in q.tags:
+                posting = index.get(t)
+                if posting is not None:
+                    parts.append(posting + row * self.size)
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return self._unique(np, np.concatenate(parts))
+
+    @staticmethod
+    def _unique(np, keys):
+        """
+        np.unique with counts by one sort, it's much faster for int keys than hashing in recent numpy.
+        """
+        if len(keys) == 0:
+            return keys, np.zeros(0, dtype=np.int64)
+        keys.sort()
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        return keys[starts], np.diff(np.append(starts, len(keys)))
+
+    def match_all(self, questions: List[Question]) -> Dict[int, List[Question]]:
+        np = load_numpy()
+        res = {}
+        if len(questions) == 0 or self.size == 0:
+            return res
+        any_keys, counts = self._pairs(np, self.any_index, questions)
+        all_keys, counts = self._pairs(np, self.all_index, questions)
+        all_keys = all_keys[counts >= self.all_size[all_keys % self.size]]
+        exclude_keys, counts = self._pairs(np, self.exclude_index, questions)
+        keys, counts = self._unique(np, np.concatenate((any_keys, all_keys)))
+        subs = keys % self.size
+        matched = (np.isin(keys, any_keys, assume_unique=True) | self.any_empty[subs])
+        matched &= (self.all_size[subs] == 0) | np.isin(keys, all_keys, assume_unique=True)
+        matched &= ~np.isin(keys, exclude_keys, assume_unique=True)
+        keys = keys[matched]
+        if len(keys) == 0:
+            return res
+        # one message per chat and question, even if several subscriptions of the chat matched it
+        chat_keys, counts = self._unique(np, self.chat_index[keys % self.size] * len(questions) + keys // self.size)
+        for chat, row in zip(self.chats[chat_keys // len(questions)].tolist(),
+                             (chat_keys % len(questions)).tolist()):
+            if chat not in res:
+                res[chat] = []
+            res[chat].append(questions[row])
+        return res
+
+
+def match_in_db(cur, site_id: int, questions: List[Question]) -> Dict[int, List[Question]]:
+    """
+    Same rules as TagMatcher, evaluated by one query over the subscriptions table with array operators.
+    Questions are passed as arrays of ids and space separated tags, stackexchange tags never contain spaces.
+    """
+    res = {}
+    if len(questions) == 0:
+        return res
+    by_id = {q.question_id: q for q in questions}
+    cur.execute("""select s.telegram_id, q.question_id
+                   from unnest(%s::bigint[], %s::text[]) q(question_id, tag_line)
+                   cross join lateral (select string_to_array(q.tag_line, ' ') tags) t
+                   join stackexchange_db.subscriptions s on s.site_id = %s
+                   and (s.tags_any && t.tags or (cardinality(s.tags_any) = 0 and cardinality(s.tags_all) > 0))
+                   and s.tags_all <@ t.tags
+                   and not (s.tags_exclude && t.tags)
+                   group by s.telegram_id, q.question_id
+                   order by s.telegram_id, q.question_id""",
+                ([q.question_id for q in questions], [" ".join(q.tags) for q in questions], site_id))
+    for usr, question_id in cur:
+        if usr not in res:
+            res[usr] = []
+        res[usr].append(by_id[question_id])
+    return res
+
+
+class MatcherRegistry:
+    """
+    Per-site matchers, built from stackexchange_db.subscriptions on first use and kept in sync by add/del commands.
+    When subscriptions are changed by another process, the registry is shared and matchers are reloaded
+    on signature change instead.
+    """
+
+    def __init__(self, shared: bool = False):
+        self.shared = shared
+        self._matchers: Dict[int, TagMatcher] = {}
+        self._lock = threading.Lock()
+
+    def get(self, site_id: int) -> TagMatcher:
+        return self._matchers.get(site_id)
+
+    def register(self, site_id: int, signature: Tuple = None) -> TagMatcher:
+        """
+        Put an empty matcher for the site, it has to be filled from subscriptions read after this call.
+        Add and del commands done meanwhile are applied to it, so none is lost between the read and the fill.
+        """
+        matcher = TagMatcher(site_id, signature)
+        matcher.start_fill()
+        with self._lock:
+            self._matchers[site_id] = matcher
+        return matcher
+
+    def discard(self, site_id: int, matcher: TagMatcher):
+        """
+        Drop a matcher which failed to fill, the next use loads it again.
+        """
+        with self._lock:
+            if self._matchers.get(site_id) is matcher:
+                del self._matchers[site_id]
+
+    def load(self, site_id: int, rows: Iterable, signature: Tuple = None) -> TagMatcher:
+        matcher = self.register(site_id, signature)
+        try:
+            matcher.fill(rows)
+        except BaseException:
+            self.discard(site_id, matcher)
+            raise
+        return matcher
+
+    def add(self, site_id: int, sub_id: int, telegram_id: int, tags_any: List[str], tags_all: List[str],
+            tags_exclude: List[str]):
+        matcher = self.get(site_id)
+        # not loaded yet, will be built from the table with this subscription
+        if matcher is not None:
+            matcher.add(sub_id, telegram_id, tags_any, tags_all, tags_exclude)
+
+    def remove(self, sub_id: int):
+        with self._lock:
+            matchers = list(self._matchers.values())
+        for m in matchers:
+            m.remove(sub_id)
+
+    def remove_chat(self, telegram_id: int):
+        with self._lock:
+            matchers = list(self._matchers.values())
+        for m in matchers:
+            m.remove_chat(telegram_id)
@@ -0,0 +1,199 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Dict, List, Tuple
+
+# seconds, from a fast DB query to a long flood control pause
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label: str = None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, label_value: str = ""):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + value
+
+    def get(self, label_value: str = "") -> float:
+        return self._values.get(label_value, 0)
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        res = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} counter".format(self.name)]
+        with self._lock:
+            for label_value, value in sorted(self._values.items()):
+                res.append("{}{} {}".format(self.name, _labels(self.label, label_value), value))
+        return res
+
+
+class Histogram:
+    """
+    Cumulative buckets are built on render, observe only increments one bucket.
+    """
+
+    def __init__(self, name: str, description: str, label: str = None, buckets: Tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        # label value: [per bucket counts with +Inf last, sum, count]
+        self._series: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label_value: str = ""):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[label_value] = series
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, label_value: str = ""):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, label_value)
+
+    def summary(self) -> Tuple[int, float, float]:
+        """
+        Return count, sum and 95th percentile estimated by bucket bounds over all label values.
+        """
+        with self._lock:
+            counts = [0] * (len(self.buckets) + 1)
+            total = 0.0
+            cnt = 0
+            for series in self._series.values():
+                for i, c in enumerate(series[0]):
+                    counts[i] += c
+                total += series[1]
+                cnt += series[2]
+        p95 = 0.0
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= cnt * 0.95:
+                p95 = self.buckets[i] if i < len(self.buckets) else float("inf")
+                break
+        return cnt, total, p95
+
+    def render(self) -> List[str]:
+        res = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            for label_value, (counts, total, cnt) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, c in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += c
+                    res.append("{}_bucket{} {}".format(self.name, _labels(self.label, label_value, bound),
+                                                       cumulative))
+                res.append("{}_sum{} {}".format(self.name, _labels(self.label, label_value), round(total, 6)))
+                res.append("{}_count{} {}".format(self.name, _labels(self.label, label_value), cnt))
+        return res
+
+
+def _labels(label: str, label_value: str, bound=None) -> str:
+    pairs = []
+    if label is not None:
+        pairs.append('{}="{}"'.format(label, label_value.replace("\\", "\\\\").replace('"', '\\"')))
+    if bound is not None:
+        pairs.append('le="{}"'.format(bound))
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+api_request_seconds = Histogram("api_request_seconds", "StackExchange API request latency", "site")
+api_backoff_seconds = Counter("api_backoff_seconds_total", "Time spent waiting for API backoff", "method")
+db_transaction_seconds = Histogram("db_transaction_seconds", "Time a connection is borrowed from the pool")
+match_seconds = Histogram("match_seconds", "Matching time of a page of questions", "engine")
+telegram_send_seconds = Histogram("telegram_send_seconds", "Telegram send_message latency")
+notifier_throttle_seconds = Counter("notifier_throttle_seconds_total", "Time notifier workers waited for rate limits")
+questions_fetched = Counter("questions_fetched_total", "Questions received from the API", "site")
+questions_new = Counter("questions_new_total", "Questions matched against subscriptions", "site")
+matches_saved = Counter("matches_total", "Messages saved to the outbox", "site")
+messages_sent = Counter("messages_sent_total", "Telegram messages sent")
+messages_failed = Counter("messages_failed_total", "Telegram messages given up")
+
+METRICS = [api_request_seconds, api_backoff_seconds, db_transaction_seconds, match_seconds, telegram_send_seconds,
+           notifier_throttle_seconds, questions_fetched, questions_new, matches_saved, messages_sent, messages_failed]
+
+
+def render() -> str:
+    res = []
+    for metric in METRICS:
+        res.extend(metric.render())
+    return chr(10).join(res) + chr(10)
+
+
+def get_summary() -> Dict:
+    """
+    Short form of all metrics for admin_stats: totals of counters, count, average and p95 of histograms.
+    """
+    res = {}
+    for metric in METRICS:
+        if isinstance(metric, Histogram):
+            cnt, total, p95 = metric.summary()
+            if cnt > 0:
+                if p95 == float("inf"):
+                    # above the top bucket, there is no bound to tell
+                    p95 = "> {} ms".format(round(metric.buckets[-1] * 1000))
+                else:
+                    p95 = "<= {} ms".format(round(p95 * 1000))
+                res[metric.name] = "count {}, avg {} ms, p95 {}".format(cnt, round(total / cnt * 1000, 1), p95)
+        else:
+            res[metric.name] = round(metric.total(), 1)
+    return res
+
+
+class MetricsServer:
+    """
+    Serves metrics in Prometheus text format on /metrics, listens on localhost only.
+    """
+
+    def __init__(self, port: int, logger: Logger, host: str = "127.0.0.1"):
+        self.port = port
+        self.host = host
+        self.logger = logger
+        self._server = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        self.logger.info("Metrics are served on {}:{}".format(self.host, self.port))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,243 @@
+import heapq
+import threading
+import time
+from collections import deque
+from logging import Logger
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import RetryAfter, Unauthorized
+
+from . import metrics
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_TRIES = 3
+WAIT_BETWEEN_TRIES = 3
+
+DEFAULT_WORKERS = 4
+# Telegram limits: about 30 messages per second overall and 1 per second to the same chat
+DEFAULT_GLOBAL_RATE = 30
+DEFAULT_CHAT_RATE = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def configure(self, rate: float):
+        with self._lock:
+            self.rate = rate
+            self.capacity = rate
+            self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def acquire(self) -> float:
+        """
+        Take one token, return seconds spent waiting for it.
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.capacity)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class Notifier:
+    """
+    Outbound message queue drained by worker threads.
+    Texts queued for one chat are joined into messages up to MAX_MESSAGE_LENGTH, chats are served
+    not more often than chat_rate and all sends together not more often than global_rate per second.
+    Texts may carry a key, keys of every sent or given up message are reported to on_delivered/on_failed.
+    """
+
+    def __init__(self, bot: Bot, logger: Logger, workers: int = DEFAULT_WORKERS,
+                 global_rate: float = DEFAULT_GLOBAL_RATE, chat_rate: float = DEFAULT_CHAT_RATE,
+                 on_blocked: Callable[[int], None] = None, on_delivered: Callable[[List], None] = None,
+                 on_failed: Callable[[List], None] = None):
+        self.bot = bot
+        self.logger = logger
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.on_blocked = on_blocked
+        self.on_delivered = on_delivered
+        self.on_failed = on_failed
+        self._bucket = TokenBucket(global_rate)
+        self._pending: Dict[int, Deque[Tuple[str, object]]] = {}
+        # chats having pending texts, ordered by the time they may be served
+        self._ready: List = []
+        self._scheduled = set()
+        self._next_allowed: Dict[int, float] = {}
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._threads = []
+        self._is_running = False
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.throttle_time = 0.0
+
+    def configure(self, global_rate: float, chat_rate: float):
+        self._bucket.configure(global_rate)
+        self.chat_rate = chat_rate
+
+    def start(self):
+        self._is_running = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="notifier-{}".format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = None):
+        with self._cond:
+            self._is_running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def put(self, chat_id: int, text: str, key=None):
+        self.put_many(chat_id, [(text, key)])
+
+    def put_many(self, chat_id: int, items: List[Tuple[str, object]]):
+        """
+        Queue a whole digest at once, so no worker sends the chat a part of it before the rest arrives.
+        """
+        with self._cond:
+            if chat_id not in self._pending:
+                self._pending[chat_id] = deque()
+            self._pending[chat_id].extend(items)
+            self._schedule(chat_id, self._next_allowed.get(chat_id, 0))
+
+    def _schedule(self, chat_id: int, at: float):
+        if chat_id in self._scheduled:
+            return
+        self._scheduled.add(chat_id)
+        self._seq += 1
+        heapq.heappush(self._ready, (at, self._seq, chat_id))
+        self._cond.notify()
+
+    def queue_size(self) -> int:
+        with self._cond:
+            return sum(len(i) for i in self._pending.values())
+
+    def _take(self) -> Optional[tuple]:
+        with self._cond:
+            while self._is_running:
+                if len(self._ready) == 0:
+                    self._cond.wait()
+                    continue
+                at, seq, chat_id = self._ready[0]
+                delay = at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._ready)
+                texts = self._pending.get(chat_id)
+                batch = []
+                length = 0
+                while texts and length + len(texts[0][0]) <= MAX_MESSAGE_LENGTH:
+                    length += len(texts[0][0])
+                    batch.append(texts.popleft())
+                if len(batch) == 0 and texts:
+                    text, key = texts.popleft()
+                    batch.append((text[:MAX_MESSAGE_LENGTH], key))
+                # the chat stays in _scheduled while in flight, so no other worker picks it
+                return chat_id, batch
+        return None
+
+    def _release(self, chat_id: int, retry_at: float = None):
+        with self._cond:
+            self._scheduled.discard(chat_id)
+            if retry_at is None:
+                retry_at = time.monotonic() + 1 / self.chat_rate
+            self._next_allowed[chat_id] = retry_at
+            if self._pending.get(chat_id):
+                self._schedule(chat_id, retry_at)
+            else:
+                self._pending.pop(chat_id, None)
+                self._next_allowed.pop(chat_id, None)
+
+    def _requeue(self, chat_id: int, batch: List):
+        with self._cond:
+            self._pending.setdefault(chat_id, deque()).extendleft(reversed(batch))
+
+    def _report(self, callback: Callable[[List], None], batch: List):
+        keys = [key for text, key in batch if key is not None]
+        if callback is None or len(keys) == 0:
+            return
+        try:
+            callback(keys)
+        except BaseException as exc:
+            self.logger.exception(exc)
+
+    def _work(self):
+        while True:
+            task = self._take()
+            if task is None:
+                return
+            chat_id, batch = task
+            msg = "".join(text for text, key in batch)
+            retry_at = None
+            cnt = 0
+            while True:
+                waited = self._bucket.acquire()
+                try:
+                    with metrics.telegram_send_seconds.time():
+                        self.bot.send_message(chat_id=chat_id, text=msg)
+                    self.sent += 1
+                    metrics.messages_sent.inc()
+                    self._report(self.on_delivered, batch)
+                    break
+                except RetryAfter as err:
+                    self.retry_after += 1
+                    self.logger.info("Flood control for chat %s, retry after %s", chat_id, err.retry_after)
+                    # limit is applied to the whole bot, so every worker has to wait
+                    self._bucket.pause(err.retry_after)
+                    self._requeue(chat_id, batch)
+                    retry_at = time.monotonic() + err.retry_after
+                    break
+                except Unauthorized as err:
+                    self.failed += 1
+                    metrics.messages_failed.inc()
+                    self.logger.info("Chat %s blocked us: %s", chat_id, err)
+                    with self._cond:
+                        batch.extend(self._pending.pop(chat_id, []))
+                    self._report(self.on_failed, batch)
+                    if self.on_blocked is not None:
+                        try:
+                            self.on_blocked(chat_id)
+                        except BaseException as exc:
+                            self.logger.exception(exc)
+                    break
+                except BaseException as err:
+                    self.logger.exception(err)
+                    cnt += 1
+                    if cnt >= MAX_TRIES:
+                        self.failed += 1
+                        metrics.messages_failed.inc()
+                        self.logger.error("Message for chat {} dropped after {} tries".format(chat_id, cnt))
+                        self._report(self.on_failed, batch)
+                        break
+                    time.sleep(WAIT_BETWEEN_TRIES)
+                finally:
+                    self.throttle_time += waited
+                    metrics.notifier_throttle_seconds.inc(waited)
+            self._release(chat_id, retry_at)
+
+    def get_stats(self) -> Dict:
+        return {"notifier_sent": self.sent, "notifier_failed": self.failed, "notifier_queued": self.queue_size(),
+                "notifier_retry_after": self.retry_after, "notifier_throttle_time": round(self.throttle_time, 1)}
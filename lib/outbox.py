@@ -0,0 +1,149 @@
+import threading
+from logging import Logger
+from typing import Dict, List
+
+from psycopg2.extras import execute_values
+
+from .notifier import Notifier
+from .question import Question
+
+STATUS_NEW = 1
+STATUS_SENT = 2
+STATUS_FAILED = 3
+STATUS_QUEUED = 4
+
+DEFAULT_BATCH_SIZE = 5000
+# sent rows are kept for a while, so a re-fetched question hits the unique key instead of the user
+KEEP_DAYS = 7
+# rows queued by a worker which didn't report back in this time are given to any worker again
+CLAIM_TIMEOUT = 900
+
+
+def format_question(q: Question) -> str:
+    return "Question: {0}, link: {1}".format(q.title, q.link) + chr(10)
+
+
+def save_matches(cur, site_id: int, matches: Dict[int, List[Question]]):
+    """
+    Store matched questions in one statement, rows already known for the chat and question are skipped.
+    """
+    rows = []
+    for usr in matches:
+        for q in matches[usr]:
+            rows.append((usr, site_id, q.question_id, format_question(q)))
+    if len(rows) == 0:
+        return
+    execute_values(cur, """insert into stackexchange_db.outbox(telegram_id, site_id, question_id, payload)
+                           values %s on conflict (telegram_id, site_id, question_id) do nothing""",
+                   rows, page_size=1000)
+
+
+class OutboxDrainer:
+    """
+    Moves new outbox rows to the notifier and stores delivery results.
+    Results come from notifier threads, they are buffered and written by sync in the caller's transaction.
+    Rows are claimed with skip locked, so several workers can drain one outbox.
+    Rows of a chat are queued together and the notifier packs them into as few messages as possible.
+    A worker running apart from updaters waits for sites to finish, so pages of a site update make one digest.
+    """
+
+    def __init__(self, notifier: Notifier, logger: Logger, batch_size: int = DEFAULT_BATCH_SIZE,
+                 wait_for_updates: bool = False):
+        self.notifier = notifier
+        self.logger = logger
+        self.batch_size = batch_size
+        self.wait_for_updates = wait_for_updates
+        self._in_flight = set()
+        self._delivered = []
+        self._failed = []
+        self._lock = threading.Lock()
+
+    def on_delivered(self, ids: List[int]):
+        with self._lock:
+            self._delivered.extend(ids)
+
+    def on_failed(self, ids: List[int]):
+        with self._lock:
+            self._failed.extend(ids)
+
+    def _set_status(self, cur, ids: List[int], status_id: int):
+        if len(ids) == 0:
+            return
+        cur.execute("""update stackexchange_db.outbox set status_id = %s, dt_sent = current_timestamp
+                       where id = any(%s)""", (status_id, ids))
+
+    def flush(self, connect):
+        """
+        Write delivery results received so far.
+        """
+        with self._lock:
+            delivered = self._delivered
+            failed = self._failed
+            self._delivered = []
+            self._failed = []
+        try:
+            cur = connect.cursor()
+            self._set_status(cur, delivered, STATUS_SENT)
+            self._set_status(cur, failed, STATUS_FAILED)
+            connect.commit()
+        except BaseException:
+            # keep results for the next try, otherwise these rows would be sent again
+            with self._lock:
+                self._delivered.extend(delivered)
+                self._failed.extend(failed)
+            raise
+        with self._lock:
+            self._in_flight.difference_update(delivered)
+            self._in_flight.difference_update(failed)
+        if len(delivered) > 0 or len(failed) > 0:
+            self.logger.info("Outbox: %s rows delivered, %s failed", len(delivered), len(failed))
+
+    def sync(self, connect):
+        self.flush(connect)
+        cur = connect.cursor()
+        in_update = ""
+        if self.wait_for_updates:
+            # a site is still fetched while its lease is held, an expired lease doesn't hold rows back
+            in_update = """and not exists (select null from stackexchange_db.site_updates u
+                                           where u.site_id = ob.site_id and u.update_status_id = 2
+                                           and u.lease_expires > current_timestamp)"""
+        cur.execute("""update stackexchange_db.outbox o set status_id = %s, dt_claimed = current_timestamp
+                       where o.id in (select ob.id from stackexchange_db.outbox ob
+                                      where (ob.status_id = %s
+                                             or (ob.status_id = %s
+                                                 and ob.dt_claimed < current_timestamp - make_interval(secs => %s)))
+                                      {}
+                                      order by ob.telegram_id, ob.id limit %s
+                                      for update skip locked)
+                       returning o.id, o.telegram_id, o.payload""".format(in_update),
+                    (STATUS_QUEUED, STATUS_NEW, STATUS_QUEUED, CLAIM_TIMEOUT, self.batch_size))
+        rows = cur.fetchall()
+        rows.sort(key=lambda x: (x[1], x[0]))
+        if len(rows) == self.batch_size and rows[0][1] != rows[-1][1]:
+            # the limit may cut rows of the last chat, give them back to be sent in one digest next time
+            last = rows[-1][1]
+            cur.execute("""update stackexchange_db.outbox set status_id = %s, dt_claimed = null
+                           where id = any(%s)""", (STATUS_NEW, [i[0] for i in rows if i[1] == last]))
+            rows = [i for i in rows if i[1] != last]
+        connect.commit()
+        digests = {}
+        with self._lock:
+            for row_id, telegram_id, payload in rows:
+                if row_id in self._in_flight:
+                    continue
+                self._in_flight.add(row_id)
+                if telegram_id not in digests:
+                    digests[telegram_id] = []
+                digests[telegram_id].append((payload, row_id))
+        for telegram_id in digests:
+            self.notifier.put_many(telegram_id, digests[telegram_id])
+        if len(digests) > 0:
+            self.logger.info("Outbox: %s rows queued for sending to %s chats",
+                             sum(len(i) for i in digests.values()), len(digests))
+
+    def cleanup(self, connect):
+        cur = connect.cursor()
+        cur.execute("""delete from stackexchange_db.outbox where status_id in (%s, %s)
+                       and dt_created < current_timestamp - make_interval(days => %s)""",
+                    (STATUS_SENT, STATUS_FAILED, KEEP_DAYS))
+        connect.commit()
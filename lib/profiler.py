@@ -0,0 +1,92 @@
+import datetime
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from .log import LOG_DIR
+
+DEFAULT_INTERVAL = 0.01
+DEFAULT_SECONDS = 60
+MAX_SECONDS = 600
+DEFAULT_TOP = 15
+# threads waiting for work sit in these files, they are left out of the top
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+
+# one profile at a time, two would sample each other
+_running = threading.Lock()
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of all threads of the process with sys._current_frames, so the profiled code runs unchanged
+    and the overhead is one stack walk per thread per interval.
+    Stacks are kept collapsed, "thread;outer;...;inner" with the number of samples, the format flame graph
+    tools read.
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Dict[str, int] = {}
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return "{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+    def run(self, seconds: float):
+        """
+        Sample for the given time in the calling thread, which is left out of samples.
+        """
+        if not _running.acquire(blocking=False):
+            raise RuntimeError("Profiler is already running")
+        try:
+            me = threading.get_ident()
+            names = {}
+            finish = time.monotonic() + seconds
+            while time.monotonic() < finish:
+                for t in threading.enumerate():
+                    names[t.ident] = t.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    key = ";".join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+                time.sleep(self.interval)
+        finally:
+            _running.release()
+
+    def top(self, cnt: int = DEFAULT_TOP) -> List[Tuple[str, int, int]]:
+        """
+        Return the hottest functions as (function, own samples, samples on stack), by own samples.
+        """
+        own = {}
+        total = {}
+        for key, n in self.stacks.items():
+            frames = key.split(";")[1:]
+            if len(frames) == 0 or frames[-1].startswith(IDLE_FILES):
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + n
+            for f in set(frames):
+                total[f] = total.get(f, 0) + n
+        res = [(f, own[f], total[f]) for f in own]
+        res.sort(key=lambda x: x[1], reverse=True)
+        return res[:cnt]
+
+    def save(self) -> str:
+        """
+        Write collapsed stacks under the log dir and return the file name.
+        """
+        file_name = LOG_DIR + "profile_{}.txt".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+        with open(file_name, "w", encoding="utf-8") as f:
+            for key, n in sorted(self.stacks.items(), key=lambda x: x[1], reverse=True):
+                f.write("{} {}".format(key, n) + chr(10))
+        return file_name
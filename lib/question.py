@@ -1,14 +1,25 @@
-from typing import List
+import sys
+from typing import Iterable
+
+
+def intern_tags(tags: Iterable[str]) -> frozenset:
+    return frozenset(sys.intern(t) for t in tags)
 
 
 class Question:
-    def __init__(self, title: str, link: str, question_id: int, creation_date: int, tags: List):
+    """
+    Tags are kept as a frozenset of interned strings: one copy of every tag text for all fetched questions
+    and a constant time membership test for the matcher.
+    """
+    __slots__ = ("title", "link", "question_id", "creation_date", "tags")
+
+    def __init__(self, title: str, link: str, question_id: int, creation_date: int, tags: Iterable[str]):
         self.title = title
         self.link = link
         self.question_id = question_id
         self.creation_date = creation_date
-        self.tags = tags
+        self.tags = intern_tags(tags or [])
 
     def __str__(self):
         return "title: {}, link: {}, question_id: {}, tags: {}".format(self.title, self.link, self.question_id,
-                                                                       self.tags)
+                                                                       sorted(self.tags))
@@ -0,0 +1,68 @@
+import time
+from typing import Dict, Optional
+
+from .api import PAGE_SIZE
+
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 3600
+# aim to catch this many questions per poll, so a busy site still fits one page
+TARGET_QUESTIONS = PAGE_SIZE // 2
+SMOOTHING = 0.3
+
+
+class PollScheduler:
+    """
+    Learns question arrival rate of every site and spaces polls so each one brings about TARGET_QUESTIONS.
+    The rate is an exponential average of questions per second over fetched windows. It's stored with the site
+    update, so it survives restarts and moves with the site between updaters.
+    """
+
+    def __init__(self, min_interval: int = DEFAULT_MIN_INTERVAL, max_interval: int = DEFAULT_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._rates: Dict[int, float] = {}
+
+    def configure(self, min_interval: int, max_interval: int):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def observe(self, site_id: int, new_questions: int, window_start: int) -> int:
+        """
+        Register poll result and return seconds until the next poll.
+        window_start is the fromdate of the request, so the window lasts until now.
+        """
+        window = max(time.time() - window_start, self.min_interval)
+        sample = new_questions / window
+        rate = self._rates.get(site_id)
+        if rate is None:
+            rate = sample
+        else:
+            rate = SMOOTHING * sample + (1 - SMOOTHING) * rate
+        self._rates[site_id] = rate
+        return self.get_interval(site_id)
+
+    def set_rate(self, site_id: int, rate: float):
+        """
+        Take the rate stored with the site, None keeps the site unknown.
+        """
+        if rate is None:
+            self._rates.pop(site_id, None)
+        else:
+            self._rates[site_id] = rate
+
+    def get_retry_interval(self, site_id: int) -> int:
+        """
+        Seconds until the next poll after a failed one, which tells nothing about the rate.
+        """
+        if site_id not in self._rates:
+            return self.min_interval
+        return self.get_interval(site_id)
+
+    def get_interval(self, site_id: int) -> int:
+        rate = self._rates.get(site_id)
+        if not rate:
+            return self.max_interval
+        return int(min(max(TARGET_QUESTIONS / rate, self.min_interval), self.max_interval))
+
+    def get_rate(self, site_id: int) -> Optional[float]:
+        return self._rates.get(site_id)
@@ -1,4 +1,5 @@
 import base64
+from functools import lru_cache
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
@@ -11,7 +12,9 @@ def is_password_encrypted(password: str) -> bool:
     return password is not None and password[-4:] == '????'
 
 
+@lru_cache(maxsize=None)
 def set_up_encryption(server_name: str, port: int) -> Fernet:
+    # key derivation takes about as long as the rest of startup, it's done once per process
     salt = bytes(port)
     # TODO: rewrite to AES
     kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
@@ -1,10 +1,12 @@
 import os
 import psutil
 import datetime
-from typing import Dict
+from typing import Callable, Dict
 
 global startup
 
+stats_sources: Dict[str, Callable[[], Dict]] = {}
+
 
 def get_memory_usage() -> float:
     process = psutil.Process(os.getpid())
@@ -36,7 +38,13 @@ def uptime() -> datetime.timedelta:
     return datetime.datetime.now().replace(microsecond=0) - startup
 
 
+def register_stats_source(name: str, source: Callable[[], Dict]):
+    stats_sources[name] = source
+
+
 def get_stats() -> Dict:
-    stats = {"memory_usage": get_memory_usage(), "memory_parcent": get_cpu_percent(), "cpu_times": get_cpu_times(),
+    stats = {"memory_usage": get_memory_usage(), "memory_percent": get_memory_percent(), "cpu_times": get_cpu_times(),
              "cpu_percent": get_cpu_percent(), "uptime": uptime()}
+    for name in stats_sources:
+        stats.update(stats_sources[name]())
     return stats
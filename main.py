@@ -1,66 +1,122 @@
 import datetime
 import json
+import threading
 import time
 import argparse
-import requests
 import psycopg2
 
-from typing import List
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from contextlib import closing
+from logging import Logger
+from typing import Callable, Dict, List
+from telegram import Bot
+from telegram.ext import Updater, CommandHandler, Dispatcher, MessageHandler, Filters
 from telegram.ext.callbackcontext import CallbackContext
 from telegram.update import Update
-from telegram.error import Unauthorized
-
-from lib.config import Config
-from lib.log import get_logger
+from telegram.utils.request import Request
+
+from lib.api import ApiClient
+from lib.cache import QuestionCache, SubscriptionCache
+from lib.catalog import SiteCatalog
+from lib.config import Config, MODE_CORE, MODE_BOT, MODE_UPDATER, MODE_WORKER
+from lib.db import Database
+from lib import metrics
+from lib.metrics import MetricsServer
+from lib.lease import LeaseKeeper
+from lib.log import configure_logger, get_logger, stop_logging
+from lib.matcher import MatcherRegistry, TagMatcher, clear_tags, load_numpy, match_in_db, ENGINE_NUMPY, \
+    ENGINE_PYTHON, ENGINE_SQL
+from lib.notifier import Notifier, MAX_MESSAGE_LENGTH
+from lib.profiler import SamplingProfiler, DEFAULT_SECONDS, MAX_SECONDS
 from lib.question import Question
-from lib.stats import set_startup, get_stats
-
-MAX_TRIES = 3
-WAIT_BETWEEN_TRIES = 3
-
-PAGE_SIZE = 100  # Max valid value
+from lib.outbox import OutboxDrainer, save_matches, STATUS_FAILED, STATUS_NEW, STATUS_QUEUED
+from lib.scheduler import PollScheduler
+from lib.stats import set_startup, get_stats, register_stats_source
 
 MODE_EMPTY = 0
 MODE_TAGS = 1
 MODE_TAGS_ALL = 2
 MODE_TAGS_EXCLUDE = 2
 
-global conn
-global site_list
+# read once at start, reloaded values wait for a restart
+RESTART_SETTINGS = ["secret", "node_name", "notifier_workers", "api_max_parallel", "api_filter", "api_quota_reserve",
+                    "metrics_port"]
+# seconds before new DB settings are tried again if the DB didn't accept them
+DB_RETRY_TIME = 60
+
+global db
+global catalog
 global handler_log
-global api_log
+global api
 global config
 global is_running
+global notifier
+global notifier_log
 
+matchers = MatcherRegistry()
+question_cache = QuestionCache()
+chat_subs = SubscriptionCache()
 
-def set_connect(cfg: Config):
-    global conn
-    conn = psycopg2.connect(dbname=cfg.db_name, user=cfg.db_user,
-                            password=cfg.db_password, host=cfg.db_host, port=cfg.db_port)
-    return conn
-
-
-def get_connect():
-    global conn
-    return conn
 
-
-def set_sites(sites):
-    global site_list
-    connect = get_connect()
-    cur = connect.cursor()
-    for i in sites:
-        if i not in site_list:
-            cur.execute("select id from stackexchange_db.sites where api_site_parameter = %s", (i,))
-            buf = cur.fetchone()
-            if buf is None:
-                cur.execute("insert into stackexchange_db.sites(api_site_parameter) values (%s) returning id", (i,))
-                buf, = cur.fetchone()
-            else:
-                buf = buf[0]
-            site_list[i] = buf
-    connect.commit()
+def refresh_sites(main_log: Logger):
+    try:
+        sites = api.request_sites()
+        if sites is None:
+            main_log.warning("Site list wasn't received, catalog isn't changed")
+            return
+        with db.transaction() as cur:
+            rows = catalog.sync(cur, sites)
+        catalog.apply(rows)
+        main_log.info("Site list renewed, {} sites received, {} known".format(len(sites), len(catalog)))
+    except BaseException as err:
+        main_log.exception(err)
+
+
+def refresh_sites_in_background(main_log: Logger):
+    threading.Thread(target=refresh_sites, args=(main_log,), name="site-refresh", daemon=True).start()
+
+
+def get_chat_subs(cur, telegram_id: int) -> List:
+    """
+    Return (id, site, tags) of the chat subscriptions ordered by id, position in the list is the number
+    shown by /list and taken by /del.
+    """
+    subs = chat_subs.get(telegram_id)
+    if subs is None:
+        cur.execute("""select s.id, st.api_site_parameter, s.tags
+                       from stackexchange_db.subscriptions s
+                       join stackexchange_db.sites st on st.id = s.site_id
+                       where s.telegram_id = %s
+                       order by s.id""", (telegram_id,))
+        subs = cur.fetchall()
+        chat_subs.put(telegram_id, subs)
+    return subs
+
+
+def delete_subscriptions(cur, telegram_id: int, sub_id: int = None) -> List[int]:
+    """
+    Delete one or all subscriptions of the chat, subscription counters of sites are decreased in the same statement.
+    """
+    cur.execute("""with d as (delete from stackexchange_db.subscriptions s
+                              where s.telegram_id = %s and (%s::integer is null or s.id = %s)
+                              returning s.id, s.site_id),
+                        c as (update stackexchange_db.sites st set n_subscriptions = st.n_subscriptions - x.cnt
+                              from (select d.site_id, count(1) cnt from d group by d.site_id) x
+                              where st.id = x.site_id)
+                   select d.id from d""", (telegram_id, sub_id, sub_id))
+    return [i for i, in cur.fetchall()]
+
+
+def delete_blocked_chat(chat_id: int):
+    global notifier_log
+    notifier_log.info("Delete subscriptions for user {} because the chat blocked us".format(chat_id))
+    with db.transaction() as cur:
+        delete_subscriptions(cur, chat_id)
+        cur.execute("""update stackexchange_db.outbox set status_id = %s
+                       where telegram_id = %s and status_id in (%s, %s)""",
+                    (STATUS_FAILED, chat_id, STATUS_NEW, STATUS_QUEUED))
+    chat_subs.invalidate(chat_id)
+    matchers.remove_chat(chat_id)
+    notifier_log.info("Deleted subscriptions for user {} ".format(chat_id))
 
 
 def other_bots(update: Update, context: CallbackContext):
@@ -116,12 +172,16 @@ def help_response(update: Update, context: CallbackContext):
 
 
 def site_list_handler(update: Update, context: CallbackContext):
-    global site_list
+    global catalog
     global handler_log
     handler_log.info("Received list command from user {}".format(update.effective_chat.id))
     msg = "Stackexchange sites supported: " + chr(10)
-    for i in site_list:
-        msg += str(i) + "," + chr(10)
+    for i in sorted(catalog.names()):
+        site = catalog.get(i)
+        if site.is_normal():
+            msg += str(i) + "," + chr(10)
+        else:
+            msg += "{} ({}),".format(i, site.state.replace("_", " ")) + chr(10)
         if len(msg) >= 500:
             context.bot.send_message(text=msg,
                                      chat_id=update.effective_chat.id)
@@ -134,14 +194,10 @@ def site_list_handler(update: Update, context: CallbackContext):
 def subs_list(update: Update, context: CallbackContext):
     global handler_log
     handler_log.info("Received list command from user {}".format(update.effective_chat.id))
-    connect = get_connect()
-    cur = connect.cursor()
-    cur.execute("""select st.api_site_parameter, row_number() over (order by s.id) rn, tags
-                        from stackexchange_db.subscriptions s
-                        join stackexchange_db.sites st on st.id = s.site_id where s.telegram_id = %s
-                        order by 2 """, (update.effective_chat.id, ))
+    with db.transaction() as cur:
+        subs = get_chat_subs(cur, update.effective_chat.id)
     msg = "Active subscriptions: " + chr(10)
-    for site, rn, tags in cur:
+    for rn, (sub_id, site, tags) in enumerate(subs, 1):
         msg += "№ {}. Site: {}, tags {}".format(rn, site, tags) + chr(10)
         if len(msg) >= 500:
             context.bot.send_message(text=msg,
@@ -159,17 +215,20 @@ def admin_stats(update: Update, context: CallbackContext):
     else:
         handler_log.critical("Received illegal admin_stats from user {}".format(update.effective_chat.id))
         return
-    connect = get_connect()
-    cur = connect.cursor()
-    cur.execute("""select count(1), st.api_site_parameter
-                        from stackexchange_db.subscriptions s
-                        join stackexchange_db.sites st
-                        on st.id = s.site_id group by st.api_site_parameter""")
+    with db.transaction() as cur:
+        cur.execute("""select st.n_subscriptions, st.api_site_parameter
+                       from stackexchange_db.sites st
+                       where st.n_subscriptions > 0
+                       order by st.n_subscriptions desc""")
+        site_stats = cur.fetchall()
     msg = ""
     stats = get_stats()
     for i in stats:
         msg += "{}: {}".format(i, stats[i]) + chr(10)
-    for cnt, nm in cur:
+    summary = metrics.get_summary()
+    for i in summary:
+        msg += "{}: {}".format(i, summary[i]) + chr(10)
+    for cnt, nm in site_stats:
         msg += "site: {}, subs: {}".format(nm, cnt) + chr(10)
     context.bot.send_message(text=msg, chat_id=update.effective_chat.id)
 
@@ -188,17 +247,53 @@ def admin_shutdown(update: Update, context: CallbackContext):
     context.bot.close()
 
 
+def admin_profile(update: Update, context: CallbackContext):
+    global handler_log
+    global config
+    if update.effective_chat.id in config.admin_list:
+        handler_log.debug("Received admin_profile from user {}".format(update.effective_chat.id))
+    else:
+        handler_log.critical("Received illegal admin_profile from user {}".format(update.effective_chat.id))
+        return
+    seconds = DEFAULT_SECONDS
+    if len(context.args) > 0:
+        try:
+            seconds = min(max(int(context.args[0]), 1), MAX_SECONDS)
+        except ValueError:
+            context.bot.send_message(text="Usage: /admin_profile <seconds>", chat_id=update.effective_chat.id)
+            return
+    chat_id = update.effective_chat.id
+    bot = context.bot
+
+    def work():
+        profiler = SamplingProfiler()
+        try:
+            profiler.run(seconds)
+        except RuntimeError as err:
+            bot.send_message(text=str(err), chat_id=chat_id)
+            return
+        file_name = profiler.save()
+        handler_log.info("Profile for {} seconds saved to {}".format(seconds, file_name))
+        msg = "Samples: {}, saved to {}".format(profiler.samples, file_name) + chr(10)
+        for func, own, total in profiler.top():
+            msg += "{} own {}% total {}%".format(
+                func, round(own * 100 / profiler.samples, 1), round(total * 100 / profiler.samples, 1)) + chr(10)
+        bot.send_message(text=msg[:MAX_MESSAGE_LENGTH], chat_id=chat_id)
+
+    # the handler thread is sampled too, it's not blocked for the whole run
+    threading.Thread(target=work, name="profiler", daemon=True).start()
+    bot.send_message(text="Profiling for {} seconds".format(seconds), chat_id=chat_id)
+
+
 def delete_sub(update: Update, context: CallbackContext):
     global handler_log
-    connect = get_connect()
-    cur = connect.cursor()
     cmd = update.message.text[5:]
     handler_log.debug("Received delete cmd for row {} and user{}".format(cmd, update.effective_chat.id))
     if cmd == "all":
-        cur.execute("""delete from stackexchange_db.subscriptions s
-                 where s.telegram_id = %s
-                                """, (update.effective_chat.id,))
-        connect.commit()
+        with db.transaction() as cur:
+            delete_subscriptions(cur, update.effective_chat.id)
+        chat_subs.invalidate(update.effective_chat.id)
+        matchers.remove_chat(update.effective_chat.id)
     else:
         try:
             rn = int(cmd)
@@ -209,34 +304,25 @@ def delete_sub(update: Update, context: CallbackContext):
             context.bot.send_message(text="Incorrect number",
                                      chat_id=update.effective_chat.id)
             return
-        cur.execute("""delete
-                       from
-                           stackexchange_db.subscriptions s
-                       where
-                           id = (
-                           select
-                               sq.id
-                           from
-                               (
-                               select
-                                   id,
-                                   row_number() over (
-                                   order by s.id) rn
-                               from
-                                   stackexchange_db.subscriptions sb
-                               where
-                                   s.telegram_id = %s) sq
-                           where
-                               sq.rn = %s)
-                        """, (update.effective_chat.id, rn))
-        connect.commit()
+        deleted = None
+        with db.transaction() as cur:
+            subs = get_chat_subs(cur, update.effective_chat.id)
+            if 1 <= rn <= len(subs):
+                deleted = delete_subscriptions(cur, update.effective_chat.id, subs[rn - 1][0])
+        if deleted is None:
+            context.bot.send_message(text="Incorrect number",
+                                     chat_id=update.effective_chat.id)
+            return
+        chat_subs.invalidate(update.effective_chat.id)
+        for sub_id in deleted:
+            matchers.remove(sub_id)
     handler_log.debug("Subscription for row {} and user {} deleted".format(cmd, update.effective_chat.id))
     context.bot.send_message(text="Subscription deleted",
                              chat_id=update.effective_chat.id)
 
 
 def add(update: Update, context: CallbackContext):
-    global site_list
+    global catalog
     global handler_log
     handler_log.info("Received add command from user {}".format(update.effective_chat.id))
     args = update.message.text.split(' ')
@@ -276,23 +362,34 @@ def add(update: Update, context: CallbackContext):
             elif mode == MODE_TAGS_EXCLUDE:
                 tags_exclude.append(i)
     if (len(tags) > 0 or len(tags_all) > 0 or len(tags_exclude) > 0) and len(site) > 0:
+        tags = clear_tags(tags)
+        tags_all = clear_tags(tags_all)
+        tags_exclude = clear_tags(tags_exclude)
         tag_base = {"tags_any": tags, "tags_all": tags_all, "tags_exclude": tags_exclude}
-        connect = get_connect()
-        cur = connect.cursor()
-        if site not in site_list:
-            cur.execute("select id from stackexchange_db.sites where api_site_parameter = %s", (site,))
-            buf = cur.fetchone()
-            if buf is None:
-                context.bot.send_message(text="Incorrect stackexchange site name: {}".format(site),
-                                         chat_id=update.effective_chat.id)
-                return
-            else:
-                site_list[site] = buf[0]
-        cur.execute("""
-        insert into stackexchange_db.subscriptions(telegram_id, site_id, tags) values (%s, %s, %s)
-        """, (update.effective_chat.id, site_list[site], json.dumps(tag_base)))
-        connect.commit()
-        context.bot.send_message(text="Subscription added",
+        with db.transaction() as cur:
+            site_id = catalog.find(cur, site)
+            if site_id is not None:
+                cur.execute("""
+                insert into stackexchange_db.subscriptions(telegram_id, site_id, tags, tags_any, tags_all, tags_exclude)
+                values (%s, %s, %s, %s::text[], %s::text[], %s::text[])
+                returning id
+                """, (update.effective_chat.id, site_id, json.dumps(tag_base), tags, tags_all, tags_exclude))
+                sub_id, = cur.fetchone()
+                cur.execute("""update stackexchange_db.sites set n_subscriptions = n_subscriptions + 1
+                               where id = %s""", (site_id,))
+        chat_subs.invalidate(update.effective_chat.id)
+        if site_id is None:
+            context.bot.send_message(text="Incorrect stackexchange site name: {}".format(site),
+                                     chat_id=update.effective_chat.id)
+            return
+        matchers.add(site_id, sub_id, update.effective_chat.id, tags, tags_all, tags_exclude)
+        msg = "Subscription added"
+        info = catalog.get(site)
+        if info is not None and info.site_url is not None:
+            msg += " for {}".format(info.site_url)
+        if info is not None and not info.is_normal():
+            msg += ", note: the site is in {} state".format(info.state.replace("_", " "))
+        context.bot.send_message(text=msg,
                                  chat_id=update.effective_chat.id)
     elif len(site) == 0:
         context.bot.send_message(text="Empty site name",
@@ -306,119 +403,194 @@ def echo(update: Update, context: CallbackContext):
     pass
 
 
-def request_questions(site: str, from_date: int) -> List[Question]:
-    global api_log
-    res = []
-    cnt = 0
-    base_url = "https://api.stackexchange.com/2.3/questions/unanswered"
-    page = 1
-    need_request = True
-    while need_request:
-        url = "{0}?order=desc&sort=activity&site={1}&fromdate={2}&pagesize={3}&page={4}".format(base_url, site,
-                                                                                                from_date,
-                                                                                                PAGE_SIZE, page)
-        while True:
-            api_log.info("Sending request {}".format(base_url))
-            try:
-                r = requests.get(url, timeout=30)
-                if r.status_code == 200:
-                    cnt = 0
-            except BaseException as err:
-                api_log.exception(err)
-                api_log.info("Sleep because error")
-                time.sleep(5)
-                api_log.info("End sleep because error")
-                cnt += 1
-                if cnt >= MAX_TRIES:
-                    break
-                continue
-            api_log.info("Answer on {} is {}".format(base_url, r.status_code))
-            api_log.debug("Full response on {} is {}".format(base_url, r.text))
-            if r.status_code == 200 or cnt >= MAX_TRIES:
-                break
-            if r.status_code in [400, 403]:
-                api_log.info("Sleep because {}".format(r.text))
-                time.sleep(5)
-                api_log.info("End sleep because {}".format(r.text))
-            cnt += 1
-            time.sleep(WAIT_BETWEEN_TRIES)
-        if r.status_code == 200:
-            obj = r.json().get("items")
-            if cnt >= MAX_TRIES:
-                need_request = False
-            else:
-                need_request = r.json().get("has_more")
-            for i in obj:
-                res.append(Question(title=i.get("title"), link=i.get("link"), question_id=i.get("question_id"),
-                                    creation_date=i.get("creation_date"),
-                                    tags=i.get("tags")))
-        else:
-            api_log.error("Incorrect response {} {} from {}" .format(r.status_code, r.text, url))
-            need_request = False
-        page += 1
-        api_log.info("Need to request more: {}, next page: {}, page size {}".format(need_request, page, PAGE_SIZE))
-
-    return res
-
-
-def request_sites():
-    cnt = 0
-    base_url = "https://api.stackexchange.com/2.3/sites"
-    url = base_url
-    while True:
-        r = requests.get(url)
-        api_log.info("Answer on {} is {}".format(base_url, r.status_code))
-        api_log.debug("Full response on {} is {}".format(base_url, r.text))
-        if r.status_code == 200 or cnt >= MAX_TRIES:
-            break
-        cnt += 1
-        time.sleep(WAIT_BETWEEN_TRIES)
-    obj = r.json().get("items")
-
-    res = []
-    if r.status_code == 200:
-        for i in obj:
-            res.append(i.get("api_site_parameter"))
-    return res
-
-
-def clear_tags(list_with_q: List) -> List:
-    res = []
-    for i in list_with_q:
-        if i[0] == "'":
-            res.append(i[1:len(i) - 1])
-        elif i[0] == '"':
-            res.append(i[1:len(i) - 1])
+def get_matcher(cur, site_id: int, site: str, main_log: Logger) -> TagMatcher:
+    matcher = matchers.get(site_id)
+    signature = None
+    if matchers.shared:
+        cur.execute("""select count(1), max(s.id) from stackexchange_db.subscriptions s where s.site_id = %s""",
+                    (site_id,))
+        signature = cur.fetchone()
+    if matcher is None or (matchers.shared and matcher.signature != signature):
+        # registered before the read, so add and del commands committed after it reach the new matcher
+        matcher = matchers.register(site_id, signature)
+        try:
+            cur.execute("""select s.id, s.telegram_id, s.tags_any, s.tags_all, s.tags_exclude
+                           from stackexchange_db.subscriptions s
+                           where s.site_id = %s""",
+                        (site_id,))
+            matcher.fill(cur)
+        except BaseException:
+            matchers.discard(site_id, matcher)
+            raise
+        main_log.info("Loaded %s subscriptions for site %s", len(matcher), site)
+    return matcher
+
+
+def release_site(cur, i, dt_next_update: datetime.datetime, max_question_id: int, max_question_time: int,
+                 question_rate: float) -> bool:
+    """
+    Finish update of the site and drop the lease, False if the lease was lost to another updater.
+    """
+    cur.execute("""update stackexchange_db.site_updates u set update_status_id = 1, dt_next_update = %s,
+                   last_question_id = %s, last_question_time = %s, question_rate = %s, lease_owner = null,
+                   lease_expires = null
+                   where u.id = %s and u.lease_owner = %s""",
+                (dt_next_update, max_question_id, max_question_time, question_rate, i[0], config.node_name))
+    return cur.rowcount == 1
+
+
+def process_page(cur, i, questions: List[Question], progress: Dict, main_log: Logger) -> bool:
+    """
+    Match one fetched page of a claimed site and save matches to the outbox, the border is moved by finish_site.
+    A page saved again after a crash hits the outbox unique key, so no message is repeated.
+    Return False if the lease was lost and nothing was saved.
+    """
+    for q in questions:
+        if progress["max_id"] is None or progress["max_id"] < q.question_id:
+            progress["max_id"] = q.question_id
+        if progress["max_time"] is None or progress["max_time"] < q.creation_date:
+            progress["max_time"] = q.creation_date
+    # skip already proceed questions
+    questions = [q for q in questions if i[1] is None or q.question_id > i[1]]
+    progress["new"] += len(questions)
+    questions = question_cache.drop_known(i[3], questions)
+    metrics.questions_new.inc(len(questions), i[3])
+    if len(questions) == 0:
+        return True
+    cur.execute("""select null from stackexchange_db.site_updates u where u.id = %s and u.lease_owner = %s""",
+                (i[0], config.node_name))
+    if cur.fetchone() is None:
+        # the site was reclaimed by another updater, it will save these matches itself
+        return False
+    engine = config.match_engine
+    if engine == ENGINE_NUMPY and load_numpy() is None:
+        engine = ENGINE_PYTHON
+    started = time.perf_counter()
+    if engine == ENGINE_SQL:
+        queued_msgs = match_in_db(cur, i[4], questions)
+    elif engine == ENGINE_NUMPY:
+        queued_msgs = get_matcher(cur, i[4], i[3], main_log).match_all_vectorized(questions)
+    else:
+        queued_msgs = get_matcher(cur, i[4], i[3], main_log).match_all(questions)
+    elapsed = time.perf_counter() - started
+    metrics.match_seconds.observe(elapsed, engine)
+    main_log.info("Matched %s questions by %s engine in %s ms", len(questions), engine, round(elapsed * 1000, 1))
+    msg_cnt = 0
+    for usr in queued_msgs:
+        msg_cnt += len(queued_msgs[usr])
+    save_matches(cur, i[4], queued_msgs)
+    metrics.matches_saved.inc(msg_cnt, i[3])
+    progress["messages"] += msg_cnt
+    main_log.info("Saved %s messages for %s users", msg_cnt, len(queued_msgs))
+    return True
+
+
+def finish_site(cur, i, progress: Dict, time_border: int, failed: bool, scheduler: PollScheduler,
+                main_log: Logger) -> bool:
+    """
+    Move the site border past all processed pages and schedule the next update.
+    A failed fetch keeps the border and the rate, pages saved before the failure are skipped next time
+    by the outbox unique key.
+    """
+    if failed:
+        interval = scheduler.get_retry_interval(i[4])
+        max_id = i[1]
+        max_time = i[2]
+        main_log.warning("Site %s wasn't fetched completely, %s messages saved, retry in %s seconds",
+                         i[3], progress["messages"], interval)
+    else:
+        interval = scheduler.observe(i[4], progress["new"], time_border)
+        max_id = progress["max_id"]
+        max_time = progress["max_time"]
+        main_log.info("Site %s got %s new questions, %s messages, next update in %s seconds",
+                      i[3], progress["new"], progress["messages"], interval)
+    dt_next_update = datetime.datetime.now() + datetime.timedelta(seconds=interval)
+    if not release_site(cur, i, dt_next_update, max_id, max_time, scheduler.get_rate(i[4])):
+        main_log.warning("Lease for site {} was lost".format(i[3]))
+        return False
+    return True
+
+
+def claim_sites(main_log: Logger) -> List:
+    """
+    Take a lease on up to updater_batch due sites. Rows locked or leased by other updaters are skipped,
+    leases of a crashed updater expire and its sites are claimed again.
+    """
+    with db.transaction() as cur:
+        cur.execute("""insert into stackexchange_db.site_updates(site_id, dt_next_update)
+                       select st.id, statement_timestamp() from stackexchange_db.sites st
+                       where exists (select null from stackexchange_db.subscriptions s where s.site_id = st.id)
+                       and not exists (select null from stackexchange_db.site_updates u where u.site_id = st.id)
+                       on conflict (site_id) do nothing""")
+        cur.execute("""select u.id, u.last_question_id, u.last_question_time, st.api_site_parameter, st.id,
+                       u.question_rate
+                       from stackexchange_db.site_updates u
+                       join stackexchange_db.sites st on st.id = u.site_id
+                       where u.dt_next_update <= statement_timestamp()
+                       and (u.lease_expires is null or u.lease_expires < statement_timestamp())
+                       and exists (select null from stackexchange_db.subscriptions s where s.site_id = st.id)
+                       order by u.dt_next_update, st.id
+                       limit %s
+                       for update of u skip locked""", (config.updater_batch,))
+        statuses = cur.fetchall()
+        main_log.info("Found %s sites to check", len(statuses))
+        allowed = set(api.plan([i[3] for i in statuses]))
+        due = [i for i in statuses if i[3] in allowed]
+        if len(due) > 0:
+            cur.execute("""update stackexchange_db.site_updates u set update_status_id = 2, lease_owner = %s,
+                           lease_expires = statement_timestamp() + make_interval(secs => %s)
+                           where u.id = any(%s)""", (config.node_name, config.lease_time, [i[0] for i in due]))
+    return due
+
+
+def update_sites(scheduler: PollScheduler, lease: LeaseKeeper, main_log: Logger, on_saved: Callable = None):
+    due = claim_sites(main_log)
+    lease.hold([i[0] for i in due])
+    borders = {}
+    for i in due:
+        main_log.info("Started update site with site_id %s update_id %s and name %s", i[4], i[0], i[3])
+        # the rate may have been learned by another updater or before a restart
+        scheduler.set_rate(i[4], i[5])
+        if i[2] is None:
+            time_border = int((datetime.datetime.now() - datetime.timedelta(hours=1)).timestamp())
         else:
-            res.append(i)
-    return res
-
-
-def main():
-    global handler_log
-    global api_log
-    global config
-    global is_running
-    global site_list
-    parser = argparse.ArgumentParser(description='Idle RPG server.')
-    parser.add_argument("--config", '-cfg', help="Path to config file", action="store", default="cfg//main.json")
-    parser.add_argument("--delay", help="Number seconds app will wait before start", action="store", default=None)
-    args = parser.parse_args()
-    if args.delay is not None:
-        time.sleep(int(args.delay))
-
-    site_list = {}
-
-    config = Config(args.config)
-    main_log = get_logger("main_bot", config.log_level, True)
-    handler_log = get_logger("handler", config.log_level, True)
-    api_log = get_logger("api", config.log_level, True)
-
-    set_connect(config)
+            time_border = i[2] - 5
+        main_log.info("Time border %s for site %s", time_border, i[3])
+        borders[i[3]] = time_border
+    by_site = {i[3]: i for i in due}
+    progress = {i[3]: {"new": 0, "messages": 0, "max_id": i[1], "max_time": i[2], "lost": False} for i in due}
+    try:
+        # pages are matched as they arrive, so a long catch-up neither waits for nor holds all of them
+        # closed here on error, so fetch workers are stopped by the updater thread before the leases are released
+        with closing(api.stream_questions(borders)) as stream:
+            for site, page, done, failed in stream:
+                i = by_site[site]
+                if not done:
+                    if progress[site]["lost"]:
+                        continue
+                    with db.transaction() as cur:
+                        saved = process_page(cur, i, page, progress[site], main_log)
+                    if not saved:
+                        main_log.warning("Lease for site {} was lost, rest of pages skipped".format(site))
+                        progress[site]["lost"] = True
+                        continue
+                    # cached only after commit, otherwise questions of a failed transaction would be skipped next time
+                    question_cache.put_many(site, page)
+                    if on_saved is not None:
+                        on_saved()
+                    continue
+                try:
+                    if not progress[site]["lost"]:
+                        with db.transaction() as cur:
+                            finish_site(cur, i, progress[site], borders[site], failed, scheduler, main_log)
+                finally:
+                    lease.release(i[0])
+    finally:
+        for i in due:
+            lease.release(i[0])
 
-    updater = Updater(token=config.secret, use_context=True)
-    dispatcher = updater.dispatcher
 
+def set_handlers(dispatcher: Dispatcher):
     start_handler = CommandHandler('start', start)
     add_handler = CommandHandler('add', add)
     sites_handler = CommandHandler('sites', site_list_handler)
@@ -429,6 +601,7 @@ def main():
     sources_handler = CommandHandler('sources', sources)
     shutdown_handler = CommandHandler('admin_shutdown', admin_shutdown)
     stats_handler = CommandHandler('admin_stats', admin_stats)
+    profile_handler = CommandHandler('admin_profile', admin_profile)
     echo_handler = MessageHandler(Filters.text & (~Filters.command), echo)
     dispatcher.add_handler(start_handler)
     dispatcher.add_handler(add_handler)
@@ -440,204 +613,204 @@ def main():
     dispatcher.add_handler(sources_handler)
     dispatcher.add_handler(shutdown_handler)
     dispatcher.add_handler(stats_handler)
+    dispatcher.add_handler(profile_handler)
     dispatcher.add_handler(echo_handler)
 
-    updater.start_polling()
 
-    is_running = True
+def main():
+    global handler_log
+    global api
+    global config
+    global is_running
+    global catalog
+    global notifier
+    global notifier_log
+    global db
+    parser = argparse.ArgumentParser(description='Idle RPG server.')
+    parser.add_argument("--config", '-cfg', help="Path to config file", action="store", default="cfg//main.json")
+    parser.add_argument("--delay", help="Number seconds app will wait before start", action="store", default=None)
+    parser.add_argument("--mode", help="Part of the bot to run: bot - telegram commands, updater - sites polling, "
+                                       "worker - notifications sending, core - everything in one process",
+                        action="store", choices=[MODE_CORE, MODE_BOT, MODE_UPDATER, MODE_WORKER], default=MODE_CORE)
+    args = parser.parse_args()
+    if args.delay is not None:
+        time.sleep(int(args.delay))
+
+    is_bot = args.mode in [MODE_CORE, MODE_BOT]
+    is_updater = args.mode in [MODE_CORE, MODE_UPDATER]
+    is_worker = args.mode in [MODE_CORE, MODE_WORKER]
+    # subscriptions are changed by another process, the updater has to check them every cycle
+    matchers.shared = args.mode != MODE_CORE
+
+    config = Config(args.config)
+    main_log = get_logger("main_bot", config.log_level, True, config.log_rate_limit)
+    handler_log = get_logger("handler", config.log_level, True, config.log_rate_limit)
+    api_log = get_logger("api", config.log_level, True, config.log_rate_limit)
+    notifier_log = get_logger("notifier", config.log_level, True, config.log_rate_limit)
+    main_log.info("Started in {} mode".format(args.mode))
+    if config.match_engine == ENGINE_NUMPY and load_numpy() is None:
+        main_log.warning("numpy isn't installed, {} engine is used instead".format(ENGINE_PYTHON))
+
+    db_log = get_logger("db", config.log_level, True, config.log_rate_limit)
+    db = Database(config, db_log, config.db_pool_min, config.db_pool_max)
+    db.wait(config.db_wait_timeout)
+    catalog = SiteCatalog(main_log)
+    with db.transaction() as cur:
+        catalog.load(cur)
+
+    metrics_server = None
+    if config.metrics_port is not None:
+        metrics_server = MetricsServer(config.metrics_port, main_log)
+        metrics_server.start()
+
+    bot = None
+    updater = None
+    if is_bot:
+        # handler workers, getUpdates and notifier workers all share the bot connection pool
+        updater = Updater(token=config.secret, use_context=True,
+                          request_kwargs={"con_pool_size": 4 + 4 + config.notifier_workers})
+        set_handlers(updater.dispatcher)
+        updater.start_polling()
+        bot = updater.bot
+    elif is_worker:
+        bot = Bot(token=config.secret, request=Request(con_pool_size=config.notifier_workers + 1))
+
+    if is_worker:
+        notifier = Notifier(bot, notifier_log, config.notifier_workers, config.telegram_global_rate,
+                            config.telegram_chat_rate, delete_blocked_chat)
+        # a worker apart from updaters can't see their cycles, it sends a digest per finished site update
+        drainer = OutboxDrainer(notifier, notifier_log, wait_for_updates=not is_updater)
+        notifier.on_delivered = drainer.on_delivered
+        notifier.on_failed = drainer.on_failed
+        notifier.start()
+        register_stats_source("notifier", notifier.get_stats)
+
+        def drainer_sync():
+            with db.connection() as connect:
+                drainer.sync(connect)
+
+    if is_updater:
+        question_cache.configure(config.question_cache_size, config.question_cache_ttl)
+        api = ApiClient(api_log, config.api_max_parallel, config.api_filter, config.api_quota_reserve,
+                        question_cache)
+        register_stats_source("api", api.get_stats)
+        register_stats_source("question_cache", question_cache.get_stats)
+        scheduler = PollScheduler(config.poll_interval_min, config.poll_interval_max)
+        lease = LeaseKeeper(db, config.node_name, main_log, config.lease_time)
+        lease.start()
+        if len(catalog) == 0:
+            # first start, sites are needed for the first cycle
+            refresh_sites(main_log)
+        else:
+            # the catalog saved in the DB is enough to start, it rarely changes
+            refresh_sites_in_background(main_log)
+
+    loggers = [main_log, handler_log, api_log, notifier_log, db_log]
+    started_with = {i: getattr(config, i) for i in RESTART_SETTINGS}
+
+    reconnect_needed = False
+    db_settings_pending = False
+    db_retry_date = datetime.datetime.now()
 
+    def apply_db_settings():
+        nonlocal reconnect_needed, db_settings_pending, db_retry_date
+        try:
+            if reconnect_needed:
+                # messages waiting in the notifier and the drainer are in memory, they don't depend on the pool
+                db.reconnect(config)
+                reconnect_needed = False
+            db.configure(config.db_pool_min, config.db_pool_max)
+            db_settings_pending = False
+        except psycopg2.Error as err:
+            db_settings_pending = True
+            db_retry_date = datetime.datetime.now() + datetime.timedelta(seconds=DB_RETRY_TIME)
+            main_log.error("Can't apply new DB settings, current connections are kept, retry in {} seconds: {}".format(
+                DB_RETRY_TIME, err))
+
+    def apply_settings():
+        nonlocal reconnect_needed
+        for name, value in started_with.items():
+            if getattr(config, name) != value:
+                main_log.warning("Setting {} was changed, it will be applied after restart".format(name))
+                setattr(config, name, value)
+        for i in loggers:
+            configure_logger(i, config.log_level, config.log_rate_limit)
+        if config.db_credential_changed:
+            reconnect_needed = True
+        if is_worker:
+            notifier.configure(config.telegram_global_rate, config.telegram_chat_rate)
+        if is_updater:
+            scheduler.configure(config.poll_interval_min, config.poll_interval_max)
+            question_cache.configure(config.question_cache_size, config.question_cache_ttl)
+            lease.lease_time = config.lease_time
+        config.mark_reload_finish()
+        apply_db_settings()
+        main_log.info("Settings reloaded")
+
+    is_running = True
     site_request_date = datetime.datetime.now()
-    r = request_sites()
-    set_sites(r)
 
     set_startup()
-    for i in config.admin_list:
-        dispatcher.bot.send_message(text="Bot started", chat_id=i)
+    if bot is not None:
+        for i in config.admin_list:
+            bot.send_message(text="Bot started in {} mode".format(args.mode), chat_id=i)
 
     while is_running:
         try:
+            config.renew_if_needed()
+            if config.reloaded:
+                apply_settings()
+            elif db_settings_pending and db_retry_date <= datetime.datetime.now():
+                apply_db_settings()
             if site_request_date + datetime.timedelta(hours=24) <= datetime.datetime.now():
-                main_log.info("Renew sites")
                 site_request_date = datetime.datetime.now()
-                r = request_sites()
-                set_sites(r)
-            connect = get_connect()
-            cur = connect.cursor()
-            dt_next_update = datetime.datetime.now() + datetime.timedelta(minutes=15)
-            cur.execute("select u.id, u.last_question_id, u.last_question_time, st.api_site_parameter, st.id"
-                        "  from stackexchange_db.site_updates u"
-                        "  right join stackexchange_db.sites st on st.id = u.site_id"
-                        "  where (u.dt_next_update <= statement_timestamp() or u.dt_next_update is null)"
-                        "  and exists (select null from stackexchange_db.subscriptions s where s.site_id = st.id)"
-                        "  order by u.dt_next_update, st.id")
-            statuses = cur.fetchall()
-            main_log.info("Found {} sites to check".format(len(statuses)))
-            for i in statuses:
-                if i[0] is None:
-                    cur.execute("""insert into stackexchange_db.site_updates(site_id, dt_next_update)
-                    values (%s, statement_timestamp()) returning id""",
-                                (i[4],))
-                    main_log.info("Saved new update status for site {}".format(i[4],))
-                    connect.commit()
-                    continue
-                msg_cnt = 0
-                cur.execute("""update stackexchange_db.site_updates u set update_status_id = 2
-                where u.id = %s""",
-                            (i[0],))
-                connect.commit()
-                main_log.info("Started update site with site_id {} update_id {} and name {}".format(i[4], i[0], i[3]))
-                if i[2] is None:
-                    time_border = int((datetime.datetime.now() - datetime.timedelta(hours=1)).timestamp())
-                else:
-                    time_border = i[2] - 5
-                main_log.info("Time border {}".format(time_border))
-                questions = request_questions(i[3], time_border)
-                if len(questions) == 0:
-                    main_log.info("Empty questions list")
-                    cur.execute("""update stackexchange_db.site_updates u set update_status_id = 1, dt_next_update = %s
-                                                    where u.id = %s""",
-                                (dt_next_update, i[0]))
-                    connect.commit()
-                    continue
-                else:
-                    main_log.info("Get {} questions".format(len(questions)))
-                cur.execute("""select s.telegram_id, tags from stackexchange_db.subscriptions s where s.site_id = %s
-                order by telegram_id""",
-                            (i[4],))
-                max_question_id = i[1]
-                max_question_time = i[2]
-                for q in questions:
-                    if max_question_id is None or max_question_id < q.question_id:
-                        max_question_id = q.question_id
-                    if max_question_time is None or max_question_time < q.creation_date:
-                        max_question_time = q.creation_date
-                while True:
-                    subs = cur.fetchmany(size=1000)
-                    main_log.info("Fetched {} subscriptions".format(len(subs)))
-                    queued_msgs = {}
-                    for q in questions:
-                        sent = False
-                        cur_id = None
-                        # skip already proceed questions
-                        if i[1] is not None and q.question_id <= i[1]:
-                            continue
-                        for s in subs:
-                            if sent and s[0] == cur_id:
-                                main_log.debug(
-                                    "Skip check for user {} because question {} is sent ".format(s[0], q.question_id))
-                                continue
-                            else:
-                                cur_id = s[0]
-                                sent = False
-                            cur_tags = s[1]
-                            tags_or = clear_tags(cur_tags.get("tags_any"))
-                            tags_and = clear_tags(cur_tags.get("tags_all"))
-                            tags_not = clear_tags(cur_tags.get("tags_exclude"))
-                            skip = False
-                            for e in tags_not:
-                                if e in q.tags:
-                                    main_log.debug(
-                                        "Failed check for question {} with tags {} on exclude tag {} "
-                                            .format(q.question_id, q.tags, e))
-                                    skip = True
-                                    break
-                            if skip:
-                                continue
-                            skip = True
-                            for o in tags_or:
-                                if o in q.tags:
-                                    main_log.debug(
-                                        "Succeed check for question {} with tags {} on or tag {} ".format(
-                                            q.question_id, q.tags, o))
-                                    skip = False
-                                    break
-                                else:
-                                    main_log.debug(
-                                        "Check for question {} with tags {} on or tag {} fail ".format(
-                                            q.question_id, q.tags, o))
-                            if skip:
-                                main_log.debug(
-                                    "Failed check for question {} with tags {} on or tags {} ".format(
-                                        q.question_id, q.tags, tags_or))
-                                continue
-                            skip = False
-                            for a in tags_and:
-                                if a not in q.tags:
-                                    main_log.debug("Succeed check for question {} with tags {} on and tag {} ".format(
-                                        q.question_id, q.tags, a))
-                                    skip = True
-                                    break
-                            if skip:
-                                continue
-                            if s[0] not in queued_msgs:
-                                queued_msgs[s[0]] = []
-                            queued_msgs[s[0]].append(q)
-                            sent = True
-                    main_log.info("Proceed {} subscriptions and {} questions".format(len(subs), len(questions)))
-                    for usr in queued_msgs:
-                        msg = ""
-                        for q in queued_msgs[usr]:
-                            buf = "Question: {0}, link: {1}".format(q.title, q.link) + chr(10)
-                            if len(msg) + len(buf) >= 4096:
-                                msg_cnt += 1
-                                dispatcher.bot.send_message(chat_id=usr,
-                                                            text=msg)
-                                msg = buf
-                                if msg_cnt % 30 == 0:
-                                    time.sleep(1)
-                                    main_log.info("Sent {} messages, sleep".format(msg_cnt))
-                            else:
-                                msg += buf
-                        try:
-                            dispatcher.bot.send_message(chat_id=usr,
-                                                        text=msg)
-                        except Unauthorized as err:
-                            main_log.exception(err)
-                            main_log.info("Delete subscriptions for user {} because he blocked us ".format(usr))
-                            cur.execute("""delete from stackexchange_db.subscriptions where telegram_id = %s""",
-                                        (usr,))
-                            main_log.info("Deleted subscriptions for user {} ".format(usr))
-                            connect.commit()
-                        msg_cnt += 1
-                        if msg_cnt % 30 == 0:
-                            time.sleep(1)
-                            main_log.info("Sent {} messages, sleep".format(msg_cnt))
-                    main_log.info("Sent {} messages".format(msg_cnt))
-                    if len(subs) < 1000:
-                        main_log.info("Proceed all".format())
-                        break
-                cur.execute("""update stackexchange_db.site_updates u set update_status_id = 1, dt_next_update = %s,
-                                last_question_id = %s, last_question_time=%s
-                                where u.id = %s""",
-                            (dt_next_update, max_question_id, max_question_time, i[0]))
-            # close transaction, even if no changes (still open and stay in idle)
-            connect.commit()
-
-            main_log.info("Sleep...")
-            time.sleep(4)
+                if is_updater:
+                    main_log.info("Renew sites")
+                    refresh_sites_in_background(main_log)
+                if is_worker:
+                    with db.connection() as connect:
+                        drainer.cleanup(connect)
+            if is_updater:
+                on_saved = None
+                if is_worker and not config.digest_per_cycle:
+                    on_saved = drainer_sync
+                update_sites(scheduler, lease, main_log, on_saved)
+            if is_worker:
+                drainer_sync()
+
+            main_log.debug("Sleep...")
+            if is_updater:
+                time.sleep(4)
+            else:
+                time.sleep(1)
 
         except psycopg2.Error as err:
+            # broken connections are dropped by the pool, next cycle gets a new one
             main_log.exception(err)
             if config.supress_errors:
-                try:
-                    set_connect(config)
-                except BaseException as err:
-                    main_log.exception(err)
-                    time.sleep(5)
+                time.sleep(5)
             else:
                 raise
         except BaseException as err:
             main_log.exception(err)
             if config.supress_errors:
                 time.sleep(60)
-                try:
-                    set_connect(config)
-                except BaseException as err:
-                    main_log.exception(err)
             else:
                 raise
-    updater.stop()
+    if updater is not None:
+        updater.stop()
+    if is_worker:
+        notifier.stop()
+        with db.connection() as connect:
+            drainer.flush(connect)
+    if is_updater:
+        lease.stop()
+        api.close()
+    if metrics_server is not None:
+        metrics_server.stop()
+    db.close()
     main_log.info("Job finished.")
+    stop_logging()
     exit(0)
 
 
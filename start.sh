@@ -1,5 +1,5 @@
 #!/bin/bash
 export APP_HOME="/usr/app/stackexchange_bot"
 cd $APP_HOME
-sleep 65
+# the bot waits for the database itself, see DB_WAIT_TIMEOUT
 python3 $APP_HOME/main.py & disown
\ No newline at end of file